@@ -0,0 +1,527 @@
+#!/usr/bin/python
+
+#
+# Microbenchmarks for the map rendering and caching code.
+#
+# Usage: python bench.py [name ...]
+#
+import glob
+import multiprocessing
+import os
+import random
+import shutil
+import sys
+import tempfile
+import time
+
+import numpy
+import wx
+
+from doc.grid import Grid
+from doc.imagecache import ImageCache
+from doc.map import MapDocument
+from doc.pixels import whiteAlpha
+from doc.strokes import StrokeTable
+from doc.surface import MapSurface
+from doc.tilecache import TileCache
+from util.rects import intersectRect
+
+TILE_SIZE = 300
+ART_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'art')
+
+_app = None
+
+def _timeit(f, repeat=3):
+	best = None
+	for i in xrange(repeat):
+		start = time.time()
+		f()
+		elapsed = time.time() - start
+		if ((best is None) or (elapsed < best)):
+			best = elapsed
+	return best
+
+def _report(name, seconds):
+	print '  %-32s %10.3f ms' % (name, seconds * 1000.0)
+
+def _randomTile(w=TILE_SIZE, h=TILE_SIZE):
+	return bytearray(os.urandom(w * h * 3))
+
+def _loopAlpha(data):
+	# The original per-pixel implementation of the white mask alpha.
+	alpha = ''
+	for i in xrange(len(data) / 3):
+		alpha += chr(255 - ((data[i*3] + data[i*3+1] + data[i*3+2]) / 3))
+	return alpha
+
+def benchAlpha():
+	print 'White-as-alpha mask, one %dx%d tile:' % (TILE_SIZE, TILE_SIZE)
+	data = _randomTile()
+	out = numpy.empty(TILE_SIZE * TILE_SIZE, dtype=numpy.uint8)
+	if (_loopAlpha(data) != whiteAlpha(data).tostring()):
+		raise Exception("Vectorized alpha does not match the reference loop.")
+	_report('python loop', _timeit(lambda: _loopAlpha(data), 1))
+	_report('whiteAlpha', _timeit(lambda: whiteAlpha(data)))
+	_report('whiteAlpha (in place)', _timeit(lambda: whiteAlpha(data, out)))
+
+class _BenchStroke(object):
+	def __init__(self, x, y, w=TILE_SIZE, h=TILE_SIZE):
+		self.x = x
+		self.y = y
+		self.w = w
+		self.h = h
+
+	def getRect(self):
+		return (self.x, self.y, self.w, self.h)
+
+	def isInside(self, x, y):
+		return ( (x >= self.x) and 
+		         (y >= self.y) and
+		         (x < (self.x + self. w)) and 
+		         (y < (self.y + self.h)) )
+
+def benchStrokes(count=100000, queries=50):
+	print 'Stroke storage, %d strokes, %d queries:' % (count, queries)
+	tile = sorted(glob.glob(os.path.join(ART_DIR, 'risus_monkey', '*.jpg')))[0]
+	_getApp()
+	rng = random.Random(1)
+	extent = int((count ** 0.5) * TILE_SIZE)
+	xs = [rng.randint(0, extent) for i in xrange(count)]
+	ys = [rng.randint(0, extent) for i in xrange(count)]
+	strokes = [_BenchStroke(x, y) for x, y in zip(xs, ys)]
+	points = [(rng.randint(0, extent), rng.randint(0, extent)) for i in xrange(queries)]
+	views = [(x, y, 1920, 1080) for x, y in points]
+
+	table = StrokeTable()
+	def build():
+		table.clear()
+		table.extend([(tile, None)], numpy.zeros(count, dtype=numpy.intp), xs, ys, numpy.zeros(count))
+	_report('table build', _timeit(build))
+	objectBytes = sum(sys.getsizeof(stroke) + sys.getsizeof(stroke.__dict__) for stroke in strokes)
+	tableBytes = sum(getattr(table, name).nbytes for name, dtype in StrokeTable.COLUMNS)
+	print '  %-32s %10.1f bytes' % ('per stroke, objects', objectBytes / float(count))
+	print '  %-32s %10.1f bytes' % ('per stroke, table', tableBytes / float(count))
+
+	def linearFind():
+		for x, y in points:
+			for stroke in reversed(strokes):
+				if (stroke.isInside(x, y)):
+					break
+	def tableFind():
+		for x, y in points:
+			table.findAt(x, y)
+	_report('findStroke, objects', _timeit(linearFind, 1))
+	_report('findStroke, table', _timeit(tableFind))
+
+	def linearQuery():
+		for rect in views:
+			[stroke for stroke in strokes if (intersectRect(stroke.getRect(), rect) is not None)]
+	def tableQuery():
+		for rect in views:
+			table.query(rect)
+	_report('1920x1080 query, objects', _timeit(linearQuery, 1))
+	_report('1920x1080 query, table', _timeit(tableQuery))
+	
+	def linearBounds():
+		min(stroke.x for stroke in strokes)
+		min(stroke.y for stroke in strokes)
+		max(stroke.x + stroke.w for stroke in strokes)
+		max(stroke.y + stroke.h for stroke in strokes)
+	_report('bounds, objects', _timeit(linearBounds, 1))
+	_report('bounds, table', _timeit(table.getBounds))
+	
+	def linearTranslate():
+		for stroke in strokes:
+			stroke.x += 1
+			stroke.y += 1
+	_report('translate, objects', _timeit(linearTranslate, 1))
+	_report('translate, table', _timeit(lambda: table.translate(1, 1)))
+	table.clear()
+
+def _getApp():
+	global _app
+	if (wx.GetApp() is None):
+		_app = wx.App(False)
+	return wx.GetApp()
+
+def _resetImageCache():
+	# Start from a cold cache, as a freshly started app would.
+	ImageCache._ImageCache__instance = None
+
+def _tileMap(tiles):
+	# A map with every tile placed once, in a square, at a random rotation.
+	_getApp()
+	rng = random.Random(1)
+	doc = MapDocument()
+	doc.new()
+	columns = int(len(tiles) ** 0.5) + 1
+	for i, path in enumerate(tiles):
+		brush = doc.setBrush(path)
+		for r in xrange(rng.randint(0, 3)):
+			brush.rotate()
+		doc.strokeBrush((i % columns) * TILE_SIZE, (i / columns) * TILE_SIZE)
+	return doc
+
+def benchFormats():
+	tiles = sorted(glob.glob(os.path.join(ART_DIR, 'risus_monkey', '*.jpg')))
+	print 'Map file formats, %d risus_monkey tiles:' % len(tiles)
+	doc = _tileMap(tiles)
+	tmpDir = tempfile.mkdtemp()
+	try:
+		names = ('map.xml', 'map.gmz')
+		for name in names:
+			path = os.path.join(tmpDir, name)
+			_report('%s save' % name, _timeit(lambda: doc._doSave(path), 1))
+			print '  %-32s %10.1f KB' % ('%s size' % name, os.path.getsize(path) / 1024.0)
+			
+		for name in names:
+			path = os.path.join(tmpDir, name)
+			def load():
+				_resetImageCache()
+				loaded = MapDocument()
+				loaded.new()
+				loaded.loadFile(path)
+				return loaded
+			_report('%s load' % name, _timeit(load, 1))
+			_report('%s load + buildImage' % name, _timeit(lambda: load().buildImage(), 1))
+	finally:
+		shutil.rmtree(tmpDir)
+
+def benchRotations():
+	tiles = sorted(glob.glob(os.path.join(ART_DIR, 'dyson', '*', '*.jpg')))
+	print 'Tile cache, %d dyson tiles at every rotation:' % len(tiles)
+	_resetImageCache()
+	_getApp()
+	doc = MapDocument()
+	doc.new()
+	columns = int(len(tiles) ** 0.5) + 1
+	for i, path in enumerate(tiles):
+		brush = doc.setBrush(path)
+		for rot in xrange(4):
+			doc.strokeBrush((i % columns) * TILE_SIZE, ((i / columns) * 4 + rot) * TILE_SIZE)
+			brush.rotate()
+	
+	cache = ImageCache.getInstance()
+	keys = set((stroke.imgPath, stroke.rot) for stroke in doc._strokes)
+	sources = [cache._getDecoded(tile) for tile in cache._cache.keys()]
+	print '  %-32s %10d' % ('path_rotation entries', len(keys))
+	print '  %-32s %10d' % ('content-hashed sources', len(sources))
+	print '  %-32s %10.1f KB' % ('decoded RGBA', 
+	                             sum(img.GetWidth() * img.GetHeight() * 4 for img in sources) / 1024.0)
+	tmpDir = tempfile.mkdtemp()
+	try:
+		path = os.path.join(tmpDir, 'map.gmz')
+		doc._doSave(path)
+		print '  %-32s %10.1f KB' % ('map.gmz size', os.path.getsize(path) / 1024.0)
+	finally:
+		shutil.rmtree(tmpDir)
+
+def benchBatch(count=2000):
+	tiles = sorted(glob.glob(os.path.join(ART_DIR, 'risus_monkey', '*.jpg')))
+	print 'Placing %d strokes with a surface listening to onMapChanged:' % count
+	_getApp()
+	rng = random.Random(1)
+	points = [(rng.randint(0, 20000), rng.randint(0, 20000)) for i in xrange(count)]
+	
+	def place(batched):
+		doc = MapDocument()
+		doc.new()
+		surface = MapSurface()
+		doc.addEventListener('onMapChanged', lambda doc, needsPaint, rect=None: surface.update(doc, rect))
+		doc.setBrush(tiles[0])
+		if (batched):
+			with doc.batch():
+				for x, y in points:
+					doc.strokeBrush(x, y)
+		else:
+			for x, y in points:
+				doc.strokeBrush(x, y)
+	_report('strokeBrush', _timeit(lambda: place(False), 1))
+	_report('strokeBrush in doc.batch()', _timeit(lambda: place(True), 1))
+
+def benchCache(budget=32 * 1024 * 1024, rounds=3):
+	sets = [sorted(glob.glob(os.path.join(ART_DIR, 'risus_monkey', '*.jpg'))),
+	        sorted(glob.glob(os.path.join(ART_DIR, 'dyson', '*', '*.jpg')))]
+	print 'Tile cache, swapping between %d tile sets %d times, %d MB budget:' % (len(sets), rounds, budget / (1024 * 1024))
+	_resetImageCache()
+	_getApp()
+	cache = ImageCache.getInstance()
+	cache.setBudget(budget)
+	doc = MapDocument()
+	doc.new()
+	def swap():
+		for i in xrange(rounds):
+			for tiles in sets:
+				doc.clearDirty()
+				doc.new()
+				doc.addStrokes([doc.createStroke(path, 0, 0) for path in tiles])
+				doc.buildImage()
+	_report('swap', _timeit(swap, 1))
+	stats = cache.getStats()
+	for name in ('hits', 'misses', 'evictions', 'tiles'):
+		print '  %-32s %10d' % (name, stats[name])
+	print '  %-32s %10.1f MB' % ('held', stats['bytes'] / (1024.0 * 1024.0))
+
+def benchDiskCache():
+	tiles = sorted(glob.glob(os.path.join(ART_DIR, 'dyson', '*', '*.jpg')))
+	print 'Decoding %d dyson tiles, with and without the disk cache:' % len(tiles)
+	_getApp()
+	tmpDir = tempfile.mkdtemp()
+	def load(disk):
+		_resetImageCache()
+		ImageCache.getInstance().setDiskCache(disk)
+		doc = MapDocument()
+		doc.new()
+		doc.addStrokes([doc.createStroke(path, 0, 0) for path in tiles])
+	try:
+		_report('no disk cache', _timeit(lambda: load(None), 1))
+		_report('cold disk cache', _timeit(lambda: load(TileCache(tmpDir)), 1))
+		_report('warm disk cache', _timeit(lambda: load(TileCache(tmpDir))))
+	finally:
+		_resetImageCache()
+		shutil.rmtree(tmpDir)
+
+def benchPrefetch():
+	tiles = sorted(glob.glob(os.path.join(ART_DIR, 'dyson', '*', '*.jpg')))
+	print 'Decoding %d dyson tiles on one and on every cpu:' % len(tiles)
+	_getApp()
+	def load(workers):
+		_resetImageCache()
+		cache = ImageCache.getInstance()
+		cache.setDiskCache(None)
+		cache.prefetch([(path, None) for path in tiles], workers)
+	_report('1 thread', _timeit(lambda: load(1)))
+	_report('%d threads' % multiprocessing.cpu_count(), _timeit(lambda: load(None)))
+	_resetImageCache()
+
+def benchComposite(size=1024):
+	tiles = sorted(glob.glob(os.path.join(ART_DIR, 'dyson', '*', '*.jpg')))
+	print 'Rendering a %dx%d region of %d dyson tiles:' % (size, size, len(tiles))
+	_resetImageCache()
+	doc = _tileMap(tiles)
+	rect = (0, 0, size, size)
+	snapshot = doc.snapshotRegion(rect)
+	_report('renderRegion (GraphicsContext)', _timeit(lambda: doc.renderRegion(rect)))
+	_report('snapshotRegion', _timeit(lambda: doc.snapshotRegion(rect)))
+	_report('StrokeSnapshot.render', _timeit(lambda: snapshot.render(rect)))
+	_report('StrokeSnapshot.render preview', _timeit(lambda: snapshot.render(rect, 4)))
+
+def benchExport():
+	tiles = sorted(glob.glob(os.path.join(ART_DIR, 'dyson', '*', '*.jpg')))
+	print 'Exporting %d dyson tiles to png:' % len(tiles)
+	_resetImageCache()
+	doc = _tileMap(tiles)
+	tmpDir = tempfile.mkdtemp()
+	wholePath = os.path.join(tmpDir, 'whole.png')
+	bandedPath = os.path.join(tmpDir, 'banded.png')
+	def whole():
+		x, y, bmp = doc.buildImage(True, False)
+		bmp.SaveFile(wholePath, wx.BITMAP_TYPE_PNG)
+	try:
+		_report('buildImage + SaveFile', _timeit(whole, 1))
+		_report('exportFile (banded)', _timeit(lambda: doc.exportFile(bandedPath), 1))
+		print '  %-32s %10.1f MB' % ('largest band', 
+		                             max(w * h * 4 for x, y, w, h in doc.getExportBands()) / (1024.0 * 1024.0))
+		wholeImg = wx.Image(wholePath)
+		bandedImg = wx.Image(bandedPath)
+		if (wholeImg.GetSize() != bandedImg.GetSize()):
+			print '  sizes differ: %s and %s' % (wholeImg.GetSize(), bandedImg.GetSize())
+		else:
+			diff = (numpy.frombuffer(wholeImg.GetDataBuffer(), dtype=numpy.uint8) != 
+			        numpy.frombuffer(bandedImg.GetDataBuffer(), dtype=numpy.uint8))
+			print '  %-32s %10d' % ('differing channels', diff.sum())
+	finally:
+		shutil.rmtree(tmpDir)
+
+def benchScaledExport(maxSize=1000):
+	tiles = sorted(glob.glob(os.path.join(ART_DIR, 'dyson', '*', '*.jpg')))
+	print 'Exporting %d dyson tiles at most %d pixels across:' % (len(tiles), maxSize)
+	_resetImageCache()
+	doc = _tileMap(tiles)
+	tmpDir = tempfile.mkdtemp()
+	fullPath = os.path.join(tmpDir, 'full.png')
+	scaledPath = os.path.join(tmpDir, 'scaled.png')
+	# Scaled bands have fractional edges; they must find the same strokes
+	# as a scan of every stroke.
+	strokes = list(doc._strokes)
+	wrong = 0
+	for rect in doc.getExportBands(doc.getExportScale(maxSize=maxSize)):
+		if (doc.findStrokes(rect) != [stroke for stroke in strokes if (intersectRect(stroke.getRect(), rect) is not None)]):
+			wrong += 1
+	print '  %-32s %10d' % ('bands finding wrong strokes', wrong)
+	try:
+		_report('full size, then scaled', _timeit(lambda: doc.exportFile(fullPath), 1))
+		_report('rendered at target scale', _timeit(lambda: doc.exportFile(scaledPath, maxSize=maxSize), 1))
+		scaled = wx.Image(scaledPath)
+		full = wx.Image(fullPath).Scale(scaled.GetWidth(), scaled.GetHeight(), wx.IMAGE_QUALITY_HIGH)
+		diff = numpy.abs(numpy.frombuffer(full.GetDataBuffer(), dtype=numpy.uint8).astype(numpy.int16) - 
+		                 numpy.frombuffer(scaled.GetDataBuffer(), dtype=numpy.uint8))
+		print '  %-32s %10.2f' % ('mean difference', diff.mean())
+		print '  %-32s %10d' % ('max difference', diff.max())
+	finally:
+		shutil.rmtree(tmpDir)
+
+def benchGray():
+	tiles = sorted(glob.glob(os.path.join(ART_DIR, 'dyson', '*', '*.jpg')))
+	print 'Grey tile storage and export, %d dyson tiles:' % len(tiles)
+	for grayscale in (False, True):
+		_resetImageCache()
+		cache = ImageCache.getInstance()
+		cache.setDiskCache(None)
+		cache.setGrayscale(grayscale)
+		doc = _tileMap(tiles)
+		name = 'decoded tiles, %s' % ('grey' if grayscale else 'rgba')
+		print '  %-32s %10.1f MB' % (name, cache.getStats()['bytes'] / (1024.0 * 1024.0))
+	tmpDir = tempfile.mkdtemp()
+	try:
+		for color in ('rgb', 'gray', 'mono'):
+			path = os.path.join(tmpDir, '%s.png' % color)
+			_report('exportFile, %s' % color, _timeit(lambda: doc.exportFile(path, color=color), 1))
+			print '  %-32s %10.1f MB' % ('%s png' % color, os.path.getsize(path) / (1024.0 * 1024.0))
+	finally:
+		shutil.rmtree(tmpDir)
+
+def benchWhiteMask(rounds=3):
+	tiles = sorted(glob.glob(os.path.join(ART_DIR, 'dyson', '*', '*.jpg')))
+	print 'Toggling the white mask %d times, %d dyson tiles:' % (rounds, len(tiles))
+	_resetImageCache()
+	cache = ImageCache.getInstance()
+	cache.setDiskCache(None)
+	doc = _tileMap(tiles)
+	doc.buildImage()
+	def toggle():
+		for i in xrange(rounds):
+			for whiteMask in (False, True):
+				cache.setWhiteMask(whiteMask)
+				doc.buildImage()
+	_report('first toggle', _timeit(toggle, 1))
+	_report('later toggles', _timeit(toggle))
+	print '  %-32s %10.1f MB' % ('held', cache.getStats()['bytes'] / (1024.0 * 1024.0))
+
+class _AllocationCounter(object):
+	"""
+	Counts the pixel buffers made while it is installed: NumPy arrays
+	that own new memory, and the wx calls that copy pixel data.
+	"""
+	METHODS = [(wx.Image, 'ConvertToBitmap'), 
+	           (wx.Image, 'Copy'), 
+	           (wx.Image, 'GetData'), 
+	           (wx.Image, 'Rotate90'), 
+	           (wx.Image, 'Scale'), 
+	           (wx.Bitmap, 'ConvertToImage')]
+	STATIC_METHODS = [(wx.Bitmap, 'FromBufferRGBA'), 
+	                  (wx.Bitmap, 'FromRGBA')]
+	ARRAY_FUNCTIONS = ['empty', 'zeros', 'array', 'ascontiguousarray']
+	
+	def __init__(self):
+		self.count = 0
+		self.bytes = 0
+		self._saved = []
+		
+	def install(self):
+		for cls, name in self.METHODS:
+			self._wrap(cls, name, False)
+		for cls, name in self.STATIC_METHODS:
+			self._wrap(cls, name, True)
+		for name in self.ARRAY_FUNCTIONS:
+			self._wrap(numpy, name, False)
+			
+	def uninstall(self):
+		for owner, name, original in reversed(self._saved):
+			if (original is None):
+				delattr(owner, name)
+			else:
+				setattr(owner, name, original)
+		self._saved = []
+		
+	def _wrap(self, owner, name, static):
+		# Inherited methods are wrapped on owner and removed again after.
+		original = vars(owner).get(name)
+		function = getattr(owner, name)
+		def wrapper(*args, **kwargs):
+			result = function(*args, **kwargs)
+			self._add(result, args)
+			return result
+		self._saved.append((owner, name, original))
+		setattr(owner, name, staticmethod(wrapper) if static else wrapper)
+		
+	def _add(self, result, args):
+		if (isinstance(result, numpy.ndarray)):
+			if ((result.base is None) and ((len(args) == 0) or (result is not args[0]))):
+				self.count += 1
+				self.bytes += result.nbytes
+		elif (isinstance(result, (str, bytearray))):
+			self.count += 1
+			self.bytes += len(result)
+		elif (hasattr(result, 'GetWidth')):
+			self.count += 1
+			self.bytes += result.GetWidth() * result.GetHeight() * 4
+
+def benchAllocations():
+	tiles = sorted(glob.glob(os.path.join(ART_DIR, 'dyson', '*', '*.jpg')))
+	print 'Pixel buffers allocated by one buildImage, %d dyson tiles:' % len(tiles)
+	_resetImageCache()
+	ImageCache.getInstance().setDiskCache(None)
+	doc = _tileMap(tiles)
+	for name in ('cold tile bitmaps', 'warm tile bitmaps'):
+		counter = _AllocationCounter()
+		counter.install()
+		try:
+			doc.buildImage()
+		finally:
+			counter.uninstall()
+		print '  %-32s %10d' % ('%s, buffers' % name, counter.count)
+		print '  %-32s %10.1f MB' % ('%s, bytes' % name, counter.bytes / (1024.0 * 1024.0))
+
+def _cellGrid(grid, gc, w, h):
+	# The original per-cell implementation of Grid.draw.
+	path = gc.CreatePath()
+	path.MoveToPoint(0, grid.h)
+	path.AddLineToPoint(grid.w, grid.h)
+	path.AddLineToPoint(grid.w, 0)
+	gc.SetPen(wx.Pen(grid.color, grid.lineWidth))
+	y = 0
+	while (y < h):
+		x = 0
+		while (x < w):
+			gc.PushState()
+			gc.Translate(x, y)
+			gc.StrokePath(path)
+			gc.PopState()
+			x += grid.w
+		y += grid.h
+
+def benchGrid(size=4096):
+	grid = Grid(27, 27)
+	print 'Grid, %dx%d region, %d cells:' % (size, size, (size / grid.w + 1) * (size / grid.h + 1))
+	_getApp()
+	bmp = wx.Bitmap.FromRGBA(size, size, 0, 0, 0, 0)
+	dc = wx.MemoryDC()
+	dc.SelectObject(bmp)
+	gc = wx.GraphicsContext.Create(dc)
+	_report('per-cell paths', _timeit(lambda: _cellGrid(grid, gc, size, size), 1))
+	_report('Grid.draw', _timeit(lambda: grid.draw(gc, size, size)))
+	gc = None
+	dc.SelectObject(wx.NullBitmap)
+
+BENCHMARKS = [('alpha', benchAlpha),
+              ('strokes', benchStrokes),
+              ('formats', benchFormats),
+              ('rotations', benchRotations),
+              ('grid', benchGrid),
+              ('batch', benchBatch),
+              ('cache', benchCache),
+              ('diskcache', benchDiskCache),
+              ('prefetch', benchPrefetch),
+              ('composite', benchComposite),
+              ('export', benchExport),
+              ('scaledexport', benchScaledExport),
+              ('gray', benchGray),
+              ('whitemask', benchWhiteMask),
+              ('allocations', benchAllocations)]
+
+if __name__ == '__main__':
+	names = sys.argv[1:]
+	for name, f in BENCHMARKS:
+		if ((len(names) == 0) or (name in names)):
+			f()
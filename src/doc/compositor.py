@@ -0,0 +1,158 @@
+import numpy
+
+# How often a render checks whether it has been cancelled, in strokes.
+CANCEL_CHECK = 64
+
+class StrokeSnapshot(object):
+	"""
+	The strokes overlapping a region of a map, bottom to top, with the
+	pixels of their tiles, composited with NumPy off the UI thread.
+	"""
+	def __init__(self, xs, ys, rots, tileIds, tiles, whiteMask):
+		self._xs = xs
+		self._ys = ys
+		self._rots = rots
+		self._tileIds = tileIds
+		self._tiles = tiles
+		self._whiteMask = whiteMask
+
+	def __len__(self):
+		return len(self._xs)
+
+	def render(self, rect, step=1, cancelled=None):
+		# An (h, w, 4) array of rect sampled every step map pixels, the
+		# same as MapDocument.renderRegion draws when step is 1.  Returns
+		# None if cancelled() becomes true part way.
+		x, y, w, h = rect
+		out = numpy.empty((-(-h // step), -(-w // step), 4), dtype=numpy.uint8)
+		out.fill(255)
+		rgb = out[:, :, :3]
+		for i in xrange(len(self._xs)):
+			if ((cancelled is not None) and ((i % CANCEL_CHECK) == 0) and cancelled()):
+				return None
+			src = self._tiles[self._tileIds[i]]
+			if (self._rots[i]):
+				src = numpy.rot90(src, -int(self._rots[i]))
+			srcH, srcW = src.shape[:2]
+			left, right, dstX = _span(int(self._xs[i]) - x, srcW, w, step)
+			top, bottom, dstY = _span(int(self._ys[i]) - y, srcH, h, step)
+			if ((left >= right) or (top >= bottom)):
+				continue
+			patch = src[top:bottom:step, left:right:step]
+			dst = rgb[dstY:dstY + patch.shape[0], dstX:dstX + patch.shape[1]]
+			if (patch.ndim == 2):
+				_blendGray(dst, patch, self._whiteMask)
+			elif (self._whiteMask):
+				_blend(dst, patch)
+			else:
+				# Unmasked tiles are opaque.
+				dst[...] = patch[:, :, :3]
+
+		if (self._whiteMask):
+			total = rgb.sum(axis=2, dtype=numpy.uint16)
+			total //= 3
+			numpy.subtract(255, total, out=out[:, :, 3], casting='unsafe')
+		return out
+
+	def renderMean(self, rect, factor, cancelled=None):
+		# An (h, w, 4) array of rect shrunk by factor, for mipmap levels
+		# above full resolution: each pixel is the mean of the factor by
+		# factor map pixels it covers, so thin lines fade rather than
+		# vanish.  Strokes are reduced one at a time, premultiplied by
+		# their alpha, and blended at the reduced size.
+		x, y, w, h = rect
+		rgb = numpy.empty((-(-h // factor), -(-w // factor), 3), dtype=numpy.float32)
+		rgb.fill(255)
+		for i in xrange(len(self._xs)):
+			if ((cancelled is not None) and ((i % CANCEL_CHECK) == 0) and cancelled()):
+				return None
+			src = self._tiles[self._tileIds[i]]
+			if (self._rots[i]):
+				src = numpy.rot90(src, -int(self._rots[i]))
+			srcH, srcW = src.shape[:2]
+			left, right, dstX, padX = _block(int(self._xs[i]) - x, srcW, w, factor)
+			top, bottom, dstY, padY = _block(int(self._ys[i]) - y, srcH, h, factor)
+			if ((left >= right) or (top >= bottom)):
+				continue
+			color, alpha = _premultiply(src[top:bottom, left:right], self._whiteMask)
+			color = _boxSum(color, padX, padY, factor)
+			alpha = _boxSum(alpha, padX, padY, factor)
+			dst = rgb[dstY:dstY + alpha.shape[0], dstX:dstX + alpha.shape[1]]
+			dst *= 1.0 - alpha / (255.0 * factor * factor)
+			dst += color / (255.0 * factor * factor)
+		
+		out = numpy.empty(rgb.shape[:2] + (4,), dtype=numpy.uint8)
+		out[:, :, :3] = rgb + 0.5
+		if (self._whiteMask):
+			total = out[:, :, :3].sum(axis=2, dtype=numpy.uint16)
+			total //= 3
+			numpy.subtract(255, total, out=out[:, :, 3], casting='unsafe')
+		else:
+			out[:, :, 3] = 255
+		return out
+	
+
+def _span(offset, size, limit, step):
+	# The source pixels [start, end) of a tile at offset that land on the
+	# step grid inside [0, limit), and the output index of the first.
+	start = max(0, -offset)
+	start += (-(offset + start)) % step
+	end = min(size, limit - offset)
+	return (start, end, (offset + start) // step)
+
+def _block(offset, size, limit, factor):
+	# The source pixels [start, end) of a tile at offset inside [0, limit),
+	# the output index of the block the first falls in and how far into
+	# that block it lies.
+	start = max(0, -offset)
+	end = min(size, limit - offset)
+	return (start, end, (offset + start) // factor, (offset + start) % factor)
+
+def _premultiply(src, whiteMask):
+	# Float colour times alpha, and alpha, of a patch of tile pixels.
+	if (src.ndim == 2):
+		color = src[:, :, numpy.newaxis].astype(numpy.float32)
+		if (not whiteMask):
+			return (color * 255, numpy.full(color.shape, 255, dtype=numpy.float32))
+		alpha = 255 - color
+	elif (not whiteMask):
+		color = src[:, :, :3].astype(numpy.float32)
+		return (color * 255, numpy.full(color.shape[:2] + (1,), 255, dtype=numpy.float32))
+	else:
+		color = src[:, :, :3].astype(numpy.float32)
+		alpha = src[:, :, 3:].astype(numpy.float32)
+	color *= alpha
+	return (color, alpha)
+
+def _boxSum(src, padX, padY, factor):
+	# Sums of src over factor by factor blocks, src starting padX and padY
+	# pixels into the first block, with transparent pixels round it.
+	h, w, channels = src.shape
+	rows = -(-(h + padY) // factor)
+	cols = -(-(w + padX) // factor)
+	if ((padX or padY) or ((rows * factor, cols * factor) != (h, w))):
+		padded = numpy.zeros((rows * factor, cols * factor, channels), dtype=numpy.float32)
+		padded[padY:padY + h, padX:padX + w] = src
+		src = padded
+	return src.reshape(rows, factor, cols, factor, channels).sum(axis=(1, 3))
+
+def _blend(dst, src):
+	# Source over an opaque destination, rounding like an 8 bit blend.
+	alpha = src[:, :, 3:].astype(numpy.uint16)
+	total = src[:, :, :3] * alpha
+	total += dst * (255 - alpha)
+	total += 127
+	total //= 255
+	dst[...] = total
+
+def _blendGray(dst, gray, whiteMask):
+	gray = gray[:, :, numpy.newaxis]
+	if (not whiteMask):
+		dst[...] = gray
+		return
+	alpha = 255 - gray.astype(numpy.uint16)
+	total = dst * (255 - alpha)
+	total += gray * alpha
+	total += 127
+	total //= 255
+	dst[...] = total
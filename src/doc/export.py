@@ -0,0 +1,215 @@
+import collections
+import glob
+import multiprocessing
+import os
+import time
+import wx
+
+from doc.map import MapDocument
+from doc.pixels import bitmapToArray
+from doc.png import FORMATS, PngWriter
+from doc.pyramid import Pyramid, TILE_SIZE
+
+_app = None
+_mapDoc = None
+_mapPath = None
+
+def initWorker():
+	# Rendering needs a wx.App, but never a window.
+	global _app
+	if (wx.GetApp() is None):
+		_app = wx.App(False)
+
+def exportMap(args):
+	inPath, outPath, scale, maxSize, color = args
+	start = time.time()
+	doc = MapDocument()
+	try:
+		doc.new()
+		doc.loadFile(inPath)
+		if (not doc.exportFile(outPath, scale, maxSize, color)):
+			return (inPath, outPath, time.time() - start, 'map is empty')
+	except Exception, e:
+		return (inPath, outPath, time.time() - start, str(e))
+	finally:
+		doc.close()
+	return (inPath, outPath, time.time() - start, None)
+
+def initMapWorker(inPath):
+	initWorker()
+	_loadMap(inPath)
+
+def _loadMap(inPath):
+	# The map a worker renders from, loaded when it is first asked for.
+	global _mapDoc, _mapPath
+	if (_mapPath != inPath):
+		if (_mapDoc is not None):
+			_mapDoc.close()
+		_mapDoc = MapDocument()
+		_mapDoc.new()
+		_mapDoc.loadFile(inPath)
+		_mapPath = inPath
+	return _mapDoc
+
+def renderBand(args):
+	rect, scale, color = args
+	return _mapDoc.renderBand(rect, scale, color)
+
+def exportMapBands(args, processes=None):
+	"""
+	Export one map, rendering its bands in a pool of worker processes.
+	"""
+	inPath, outPath, scale, maxSize, color = args
+	start = time.time()
+	if (processes is None):
+		processes = multiprocessing.cpu_count()
+	# The workers are started before this process creates its wx.App,
+	# which they must not inherit.
+	pool = multiprocessing.Pool(processes, initMapWorker, (inPath,))
+	doc = None
+	try:
+		initWorker()
+		doc = MapDocument()
+		doc.new()
+		doc.loadFile(inPath)
+		scale = doc.getExportScale(scale, maxSize)
+		bands = doc.getExportBands(scale)
+		if (bands is None):
+			return (inPath, outPath, time.time() - start, 'map is empty')
+		w, h = doc.getExportSize(scale)
+		
+		writer = PngWriter(outPath, w, h, *FORMATS[color])
+		try:
+			bands = collections.deque(bands)
+			results = collections.deque()
+			while (bands or results):
+				while (bands and (len(results) < (processes * 2))):
+					results.append(pool.apply_async(renderBand, ((bands.popleft(), scale, color),)))
+				writer.write(results.popleft().get())
+		finally:
+			writer.close()
+	except Exception, e:
+		return (inPath, outPath, time.time() - start, str(e))
+	finally:
+		if (doc is not None):
+			doc.close()
+		pool.terminate()
+		pool.join()
+	return (inPath, outPath, time.time() - start, None)
+
+def renderTile(args):
+	inPath, path, rect, scale = args
+	_renderTile(_loadMap(inPath), path, rect, scale)
+	
+def _renderTile(doc, path, rect, scale):
+	bmp = doc.renderRegion(rect, True, False, scale)
+	writer = PngWriter(path, bmp.GetWidth(), bmp.GetHeight())
+	try:
+		writer.write(bitmapToArray(bmp)[:, :, :3])
+	finally:
+		writer.close()
+
+def exportPyramid(args, pool=None, tileSize=TILE_SIZE):
+	"""
+	Export one map as a Deep Zoom pyramid, skipping the tiles that are
+	unchanged since the last export to the same place.
+	"""
+	inPath, outPath = args
+	start = time.time()
+	doc = None
+	try:
+		initWorker()
+		doc = MapDocument()
+		doc.new()
+		doc.loadFile(inPath)
+		rect = doc.getExportRect()
+		if ((rect[2] < 1) or (rect[3] < 1)):
+			return (inPath, outPath, time.time() - start, 'map is empty')
+		
+		pyramid = Pyramid(outPath, rect, tileSize)
+		pyramid.makeDirs()
+		oldManifest = pyramid.loadManifest()
+		manifest = {}
+		jobs = []
+		for tile in pyramid.getTiles():
+			tileRect = pyramid.getTileRect(*tile)
+			manifest[tile] = doc.getRegionKey(tileRect, True)
+			path = pyramid.getTilePath(*tile)
+			if ((oldManifest.get(tile) != manifest[tile]) or (not os.path.exists(path))):
+				jobs.append((inPath, path, tileRect, pyramid.getScale(tile[0])))
+				
+		if (pool is None):
+			for job in jobs:
+				_renderTile(doc, *job[1:])
+		else:
+			for result in pool.imap_unordered(renderTile, jobs, 4):
+				pass
+		pyramid.writeDescriptor()
+		pyramid.saveManifest(manifest, oldManifest)
+	except Exception, e:
+		return (inPath, outPath, time.time() - start, str(e))
+	finally:
+		if (doc is not None):
+			doc.close()
+	return (inPath, outPath, time.time() - start, None)
+
+def findMaps(patterns):
+	paths = []
+	for pattern in patterns:
+		matches = sorted(glob.glob(pattern))
+		if (len(matches) == 0):
+			matches = [pattern]
+		for path in matches:
+			if (path not in paths):
+				paths.append(path)
+	return paths
+
+def getOutputPath(inPath, outDir=None, ext='.png'):
+	name = os.path.splitext(os.path.basename(inPath))[0] + ext
+	if (outDir is None):
+		return os.path.join(os.path.dirname(inPath), name)
+	return os.path.join(outDir, name)
+
+def exportMaps(patterns, outDir=None, processes=None, scale=1.0, maxSize=None, color='rgb'):
+	"""
+	Export every map file matching patterns to a png in a pool of worker
+	processes.  Yields (inPath, outPath, seconds, error) for each map.
+	"""
+	jobs = [(path, getOutputPath(path, outDir), scale, maxSize, color) for path in findMaps(patterns)]
+	if ((outDir is not None) and not os.path.isdir(outDir)):
+		os.makedirs(outDir)
+	if ((processes != 1) and (len(jobs) == 1)):
+		yield exportMapBands(jobs[0], processes)
+	elif ((processes == 1) or (len(jobs) < 2)):
+		initWorker()
+		for job in jobs:
+			yield exportMap(job)
+	else:
+		pool = multiprocessing.Pool(processes, initWorker)
+		try:
+			for result in pool.imap_unordered(exportMap, jobs):
+				yield result
+		finally:
+			pool.close()
+			pool.join()
+
+def exportPyramids(patterns, outDir=None, processes=None, tileSize=TILE_SIZE):
+	"""
+	Export every map file matching patterns as a Deep Zoom pyramid.
+	Yields (inPath, outPath, seconds, error) for each map.
+	"""
+	jobs = [(path, getOutputPath(path, outDir, '.dzi')) for path in findMaps(patterns)]
+	if ((outDir is not None) and not os.path.isdir(outDir)):
+		os.makedirs(outDir)
+	# One pool serves every map, started before this process creates its
+	# wx.App, which the workers must not inherit.
+	pool = None
+	if (processes != 1):
+		pool = multiprocessing.Pool(processes, initWorker)
+	try:
+		for job in jobs:
+			yield exportPyramid(job, pool, tileSize)
+	finally:
+		if (pool is not None):
+			pool.terminate()
+			pool.join()
@@ -1,4 +1,5 @@
 from lxml import etree
+import math
 import wx
 
 class Grid(object):
@@ -13,44 +14,41 @@ class Grid(object):
 		self.snapEnabled = False
 		self.renderAbove = True
 
-	def _createGridPath(self, gc):
-		path = gc.CreatePath()
-		path.MoveToPoint(0, self.h)
-		path.AddLineToPoint(self.w, self.h)
-		path.AddLineToPoint(self.w, 0)
-		return path
-
 	def draw(self, gc, w, h):
-		gc.PushState()
-		
-		path = self._createGridPath(gc)
-		gc.SetPen(wx.Pen(self.color, self.lineWidth))
-
+		# Every cell edge is added to a single path, so drawing costs one
+		# StrokePath however many cells are visible.
 		startX = self.x
 		while (startX > 0):
 			startX -= self.w
 		startY = self.y
 		while (startY > 0):
 			startY -= self.h
-		gc.Translate(startX, startY)
 
-		x = startX
-		y = startY
-		gc.PushState() 
-		while x < w:
-			gc.PushState()
-			while y < h:
-				gc.StrokePath(path)
-				gc.Translate(0, self.h)
-				y += self.h
-			gc.PopState()
-			gc.Translate(self.w, 0)
-			x += self.w
-			y = startY
-		gc.PopState()     
-		
+		cols = int(math.ceil((w - startX) / float(self.w)))
+		rows = int(math.ceil((h - startY) / float(self.h)))
+		if ((cols <= 0) or (rows <= 0)):
+			return
+		right = startX + (cols * self.w)
+		bottom = startY + (rows * self.h)
+
+		path = gc.CreatePath()
+		for i in xrange(1, cols + 1):
+			path.MoveToPoint(startX + (i * self.w), startY)
+			path.AddLineToPoint(startX + (i * self.w), bottom)
+		for j in xrange(1, rows + 1):
+			path.MoveToPoint(startX, startY + (j * self.h))
+			path.AddLineToPoint(right, startY + (j * self.h))
+
+		gc.PushState()
+		gc.SetPen(wx.Pen(self.color, self.lineWidth))
+		gc.StrokePath(path)
 		gc.PopState()
 
+	def getKey(self):
+		# Everything that changes how the grid is drawn.
+		return (self.x, self.y, self.w, self.h, self.lineWidth, 
+		        self.color.GetAsString(wx.C2S_HTML_SYNTAX))
+
 	def snap(self, x, y, scale):
 		w = self.w * scale
 		h = self.h * scale
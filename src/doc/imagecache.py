@@ -0,0 +1,496 @@
+import base64
+import collections
+import functools
+import hashlib
+import io
+import multiprocessing
+import numpy
+import time
+import wx
+import zipfile
+from lxml import etree
+from multiprocessing.pool import ThreadPool
+
+from doc.pixels import PixelBuffer, arrayToBitmap, arrayToImage, grayLevels, grayToArray, maskAlpha, rgbToArray
+from doc.png import PngWriter
+from doc.tilecache import TileCache
+
+# Bytes of decoded tiles and bitmaps kept for tiles no stroke uses.
+CACHE_BUDGET = 256 * 1024 * 1024
+
+# Quarter turns a tile can be drawn at.
+ROTATIONS = 4
+
+class _PendingImage(object):
+	"""
+	Stands in for a cached image whose encoded payload has been read from
+	a map file but not decoded yet; nbytes is the size of the payload.
+	"""
+	def __init__(self, w, h, decode, nbytes, png=None):
+		self._w = w
+		self._h = h
+		self.decode = decode
+		self.nbytes = nbytes
+		self.png = png
+		
+	def GetWidth(self):
+		return self._w
+	
+	def GetHeight(self):
+		return self._h
+	
+
+class ImageCache(object):
+	"""
+	Holds every tile image in use, keyed by a hash of its unrotated
+	pixels, with per mask mode bitmaps and arrays made from it.  Tiles no
+	stroke references are evicted, least recently released first, once
+	the cache is over its byte budget.
+	"""
+	__instance = None
+
+	@staticmethod
+	def getInstance():
+		if ImageCache.__instance is None:
+			ImageCache.__instance = ImageCache()
+		return ImageCache.__instance
+
+	def __init__(self, budget=CACHE_BUDGET):
+		self._cache = {}
+		self._alphaCache = {}
+		self._bmpCache = {}
+		self._pixelCache = {}
+		self._scaledCache = {}
+		self._pathTiles = {}
+		self._legacy = {}
+		self._unused = collections.OrderedDict()
+		self._disk = None
+		self._diskDefault = True
+		self._whiteMask = True
+		self._grayscale = True
+		self._budget = budget
+		self._bytes = 0
+		self.hits = 0
+		self.misses = 0
+		self.evictions = 0
+		
+	def setDiskCache(self, disk):
+		# A TileCache, or None to keep tiles in memory only.
+		self._disk = disk
+		self._diskDefault = False
+		
+	def _getDiskCache(self):
+		if (self._diskDefault):
+			self._disk = TileCache(TileCache.getDefaultDir())
+			self._diskDefault = False
+		return self._disk
+		
+	def setBudget(self, budget):
+		self._budget = budget
+		self._evict()
+		
+	def getStats(self):
+		return {'hits': self.hits,
+		        'misses': self.misses,
+		        'evictions': self.evictions,
+		        'bytes': self._bytes,
+		        'budget': self._budget,
+		        'tiles': len(self._cache),
+		        'unused': len(self._unused)}
+		
+	def setWhiteMask(self, whiteMask):
+		self._whiteMask = whiteMask
+		
+
+	def getWhiteMask(self):
+		return self._whiteMask
+	
+	def setGrayscale(self, grayscale):
+		self._grayscale = grayscale
+	
+	def acquireImage(self, imgPath, rot, tile=None, count=1):
+		# Returns the tile's id and rotated size; count 0 only looks it up.
+		if (tile in self._cache):
+			self.hits += 1
+		else:
+			tile = self._findTile(imgPath)
+		entry = self._cache[tile]
+		entry[1] += count
+		if (entry[1] > 0):
+			self._unused.pop(tile, None)
+		elif (tile not in self._unused):
+			self._unused[tile] = None
+		w = entry[0].GetWidth()
+		h = entry[0].GetHeight()
+		if (rot % 2):
+			return (tile, h, w)
+		return (tile, w, h)
+
+	def getPixels(self, tile):
+		# Read-only (h, w, 4) RGBA, or (h, w) grey levels for a grey tile.
+		key = (tile, self._whiteMask)
+		pixels = self._pixelCache.get(key)
+		if (pixels is not None):
+			self.hits += 1
+			return pixels
+		self.misses += 1
+		disk = self._getDiskCache()
+		if (disk is not None):
+			pixels = disk.load(tile, self._whiteMask)
+		if (pixels is None):
+			img = self._getStored(tile)
+			if (img.isGray()):
+				pixels = img.pixels
+			else:
+				pixels = self._getArray(tile, self._whiteMask)
+			pixels.flags.writeable = False
+		self._pixelCache[key] = pixels
+		self._bytes += pixels.nbytes
+		self._evict()
+		return pixels
+	
+	def getScaledImage(self, tile, rot, scale):
+		scaled = self._scaledCache.setdefault(tile, {})
+		key = (rot, scale, self._whiteMask)
+		bmp = scaled.get(key)
+		if (bmp is not None):
+			self.hits += 1
+			return bmp
+		self.misses += 1
+		img = arrayToImage(numpy.rot90(self._getArray(tile, self._whiteMask), -rot))
+		img = img.Scale(max(1, int(round(img.GetWidth() * scale))), 
+		                max(1, int(round(img.GetHeight() * scale))), 
+		                wx.IMAGE_QUALITY_HIGH)
+		bmp = scaled[key] = img.ConvertToBitmap()
+		self._bytes += self._getBitmapBytes(bmp)
+		self._evict()
+		return bmp
+	
+	def getImage(self, tile):
+		key = (tile, self._whiteMask)
+		bmp = self._bmpCache.get(key)
+		if (bmp is not None):
+			self.hits += 1
+			return bmp
+		self.misses += 1
+		bmp = self._bmpCache[key] = arrayToBitmap(self._getArray(tile, self._whiteMask))
+		self._bytes += self._getBitmapBytes(bmp)
+		self._evict()
+		return bmp
+	
+	def releaseImage(self, tile, count=1):
+		entry = self._cache.get(tile)
+		if ((entry is not None) and (entry[1] > 0)):
+			entry[1] -= min(count, entry[1])
+			if (entry[1] == 0):
+				self._unused[tile] = None
+				self._evict()
+				
+	def _evict(self):
+		for tile in self._unused.keys():
+			if (self._bytes <= self._budget):
+				break
+			entry = self._cache[tile]
+			self._bytes -= self._getBytes(entry[0])
+			alpha = self._alphaCache.pop(tile, None)
+			if (alpha is not None):
+				self._bytes -= alpha.nbytes
+			for whiteMask in (True, False):
+				bmp = self._bmpCache.pop((tile, whiteMask), None)
+				if (bmp is not None):
+					self._bytes -= self._getBitmapBytes(bmp)
+				pixels = self._pixelCache.pop((tile, whiteMask), None)
+				if (pixels is not None):
+					self._bytes -= pixels.nbytes
+			for bmp in self._scaledCache.pop(tile, {}).itervalues():
+				self._bytes -= self._getBitmapBytes(bmp)
+			del self._cache[tile]
+			del self._unused[tile]
+			self.evictions += 1
+			
+	def _getBytes(self, img):
+		if (isinstance(img, _PendingImage)):
+			return img.nbytes
+		return img.pixels.nbytes
+	
+	def _getBitmapBytes(self, bmp):
+		return bmp.GetWidth() * bmp.GetHeight() * 4
+				
+	def _findTile(self, imgPath):
+		tile = self._pathTiles.get(imgPath)
+		if (tile in self._cache):
+			self.hits += 1
+			return tile
+		self.misses += 1
+		
+		# Maps saved before tiles were keyed by content embed each
+		# rotation separately; any of them turned back gives the source.
+		tile = None
+		for rot in xrange(ROTATIONS):
+			legacy = self._legacy.pop("%s_%s" % (imgPath, rot), None)
+			if ((legacy is not None) and (tile is None)):
+				img = legacy.decode()
+				tile = self._addDecoded(PixelBuffer(numpy.rot90(img.pixels, rot)))
+		if (tile is None):
+			tile, img, alpha, decodeTime, maskTime = self._readFile(imgPath, self._getDiskCache())
+			self._addImage(tile, img, alpha)
+		self._pathTiles[imgPath] = tile
+		return tile
+	
+	def prefetch(self, paths, workers=None):
+		# Decodes uncached brush files on a pool of threads.  Returns the
+		# seconds spent decoding and masking.
+		files = []
+		for imgPath, tile in paths:
+			if ( (tile in self._cache) or 
+			     (self._pathTiles.get(imgPath) in self._cache) or 
+			     (imgPath in files) or 
+			     self._hasLegacy(imgPath) ):
+				continue
+			files.append(imgPath)
+		if (len(files) == 0):
+			return (0.0, 0.0)
+		
+		disk = self._getDiskCache()
+		if (workers is None):
+			workers = multiprocessing.cpu_count()
+		pool = ThreadPool(min(workers, len(files)))
+		try:
+			results = pool.map(lambda imgPath: self._readFile(imgPath, disk), files)
+		finally:
+			pool.close()
+			pool.join()
+			
+		decodeTime = 0.0
+		maskTime = 0.0
+		for imgPath, (tile, img, alpha, decoded, masked) in zip(files, results):
+			self.misses += 1
+			self._addImage(tile, img, alpha)
+			self._pathTiles[imgPath] = tile
+			decodeTime += decoded
+			maskTime += masked
+		return (decodeTime, maskTime)
+	
+	def _hasLegacy(self, imgPath):
+		for rot in xrange(ROTATIONS):
+			if (("%s_%s" % (imgPath, rot)) in self._legacy):
+				return True
+		return False
+	
+	def _readFile(self, imgPath, disk):
+		# Returns (tile, img, alpha, decode seconds, mask seconds).  Only
+		# reads the cache, so it is safe on worker threads.
+		start = time.time()
+		fileHash = None
+		if (disk is not None):
+			try:
+				fileHash = disk.hashFile(imgPath)
+			except IOError:
+				pass
+		if (fileHash is not None):
+			tile = disk.findTile(fileHash)
+			if (tile in self._cache):
+				return (tile, None, None, time.time() - start, 0.0)
+			if (tile is not None):
+				pixels = disk.load(tile, self._whiteMask)
+				if (pixels is not None):
+					img, alpha = self._fromArray(pixels)
+					return (tile, img, alpha, time.time() - start, 0.0)
+				
+		img = PixelBuffer.fromImage(wx.Image(imgPath))
+		tile = self._hashImage(img)
+		decoded = time.time()
+		img, alpha = self._store(img)
+		masked = time.time()
+		if (fileHash is not None):
+			disk.save(tile, self._whiteMask, self._toArray(img, alpha))
+			disk.addFile(fileHash, tile)
+		return (tile, img, alpha, decoded - start, masked - decoded)
+	
+	def _addImage(self, tile, img, alpha=None):
+		if ((img is not None) and (tile not in self._cache)):
+			self._cache[tile] = [img, 0]
+			self._bytes += self._getBytes(img)
+			self._addAlpha(tile, alpha)
+	
+	def _addAlpha(self, tile, alpha):
+		if ((alpha is not None) and (tile not in self._alphaCache)):
+			self._alphaCache[tile] = alpha
+			self._bytes += alpha.nbytes
+	
+	def _addDecoded(self, img):
+		tile = self._hashImage(img)
+		if (tile not in self._cache):
+			img, alpha = self._store(img)
+			self._addImage(tile, img, alpha)
+			self._saveToDisk(tile, img, alpha)
+		return tile
+	
+	def _store(self, img):
+		if (img.isGray()):
+			return (img, None)
+		if (self._grayscale):
+			gray = grayLevels(img.pixels)
+			if (gray is not None):
+				return (PixelBuffer(gray), None)
+		if (self._whiteMask):
+			return (img, maskAlpha(img.pixels))
+		return (img, None)
+	
+	def _toArray(self, img, alpha=None):
+		if (img.isGray()):
+			return img.pixels
+		return rgbToArray(img.pixels, alpha)
+	
+	def _fromArray(self, pixels):
+		if (pixels.ndim == 2):
+			return (PixelBuffer(pixels), None)
+		if (self._whiteMask):
+			return (PixelBuffer(pixels[:, :, :3]), pixels[:, :, 3])
+		return (PixelBuffer(pixels[:, :, :3]), None)
+	
+	def _saveToDisk(self, tile, img, alpha):
+		disk = self._getDiskCache()
+		if (disk is not None):
+			disk.save(tile, self._whiteMask, self._toArray(img, alpha))
+				
+	def _getStored(self, tile):
+		entry = self._cache[tile]
+		if (isinstance(entry[0], _PendingImage)):
+			disk = self._getDiskCache()
+			pixels = None
+			if (disk is not None):
+				pixels = disk.load(tile, self._whiteMask)
+			if (pixels is not None):
+				img, alpha = self._fromArray(pixels)
+			else:
+				img, alpha = self._store(entry[0].decode())
+				self._saveToDisk(tile, img, alpha)
+			self._bytes += self._getBytes(img) - self._getBytes(entry[0])
+			entry[0] = img
+			self._addAlpha(tile, alpha)
+		return entry[0]
+	
+	def _getAlpha(self, tile):
+		alpha = self._alphaCache.get(tile)
+		if (alpha is None):
+			alpha = maskAlpha(self._getStored(tile).pixels)
+			self._addAlpha(tile, alpha)
+			self._evict()
+		return alpha
+	
+	def _getArray(self, tile, whiteMask):
+		img = self._getStored(tile)
+		if (img.isGray()):
+			return grayToArray(img.pixels, whiteMask)
+		if (whiteMask):
+			return rgbToArray(img.pixels, self._getAlpha(tile))
+		return rgbToArray(img.pixels)
+	
+	def _getDecoded(self, tile):
+		return arrayToImage(self._getArray(tile, self._whiteMask))
+	
+	def _hashImage(self, img):
+		sha = hashlib.sha1('%dx%d:' % (img.GetWidth(), img.GetHeight()))
+		sha.update(numpy.ascontiguousarray(img.pixels))
+		return sha.hexdigest()
+				
+	def toNode(self):
+		node = etree.Element("images")
+		if (self._whiteMask):
+			node.set('whiteMask', 'true')
+		for tile in self._getUsedTiles():
+			img = self._getStored(tile)
+			subNode = etree.Element("image")
+			subNode.set('id', tile)
+			subNode.set('w', '%s' % img.GetWidth())
+			subNode.set('h', '%s' % img.GetHeight())
+			if (img.isGray()):
+				subNode.set('format', 'gray')
+			subNode.text = base64.b64encode(img.pixels.tostring())
+			node.append(subNode)
+		self._evict()
+		return node
+	
+	def _getUsedTiles(self):
+		return [tile for tile, val in self._cache.iteritems() if (val[1] > 0)]
+	
+	def fromNode(self, node):
+		self.setWhiteMask(node.get('whiteMask') == 'true')
+		for subNode in node:
+			self.addImageNode(subNode)
+			
+	def addImageNode(self, subNode):
+		w = int(subNode.get('w'))
+		h = int(subNode.get('h'))
+		if (subNode.get('format') == 'gray'):
+			decode = functools.partial(self._decodeGray, w, h, subNode.text)
+		else:
+			decode = functools.partial(self._decodeRaw, w, h, subNode.text)
+		self._addPending(subNode, _PendingImage(w, h, decode, len(subNode.text)))
+				
+	def toArchive(self, archive):
+		node = etree.Element("images")
+		if (self._whiteMask):
+			node.set('whiteMask', 'true')
+		for tile in self._getUsedTiles():
+			img = self._cache[tile][0]
+			if (isinstance(img, _PendingImage) and (img.png is not None)):
+				png = img.png
+			else:
+				png = self._encodePng(self._getStored(tile))
+			src = 'tiles/%s.png' % tile
+			archive.writestr(src, png, zipfile.ZIP_STORED)
+			subNode = etree.Element("image")
+			subNode.set('id', tile)
+			subNode.set('w', '%s' % img.GetWidth())
+			subNode.set('h', '%s' % img.GetHeight())
+			subNode.set('src', src)
+			node.append(subNode)
+		return node
+	
+	def fromArchive(self, node, archive):
+		self.setWhiteMask(node.get('whiteMask') == 'true')
+		payloads = {}
+		for subNode in node:
+			src = subNode.get('src')
+			if (src not in payloads):
+				payloads[src] = archive.read(src)
+			png = payloads[src]
+			self._addPending(subNode,
+			                 _PendingImage(int(subNode.get('w')), 
+			                               int(subNode.get('h')), 
+			                               functools.partial(self._decodePng, png),
+			                               len(png), png))
+			
+	def _addPending(self, subNode, pending):
+		tile = subNode.get('id')
+		if (tile is not None):
+			if (tile not in self._cache):
+				self._cache[tile] = [pending, 0]
+				self._unused[tile] = None
+				self._bytes += pending.nbytes
+		else:
+			# An older file, keyed by path and rotation.
+			self._legacy[subNode.get('path')] = pending
+			
+	def dropLegacy(self):
+		self._legacy.clear()
+				
+	def _encodePng(self, img):
+		# Only the colour data is stored; alpha comes from the white mask.
+		stream = io.BytesIO()
+		writer = PngWriter(stream, img.GetWidth(), img.GetHeight(), 1 if img.isGray() else 3)
+		writer.write(img.pixels)
+		writer.close()
+		return stream.getvalue()
+	
+	def _decodePng(self, png):
+		return PixelBuffer.fromImage(wx.Image(io.BytesIO(png), wx.BITMAP_TYPE_PNG))
+	
+	def _decodeGray(self, w, h, text):
+		return PixelBuffer(numpy.frombuffer(base64.b64decode(text), dtype=numpy.uint8).reshape(h, w))
+	
+	def _decodeRaw(self, w, h, text):
+		return PixelBuffer(numpy.frombuffer(base64.b64decode(text), dtype=numpy.uint8).reshape(h, w, 3))
+	
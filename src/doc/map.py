@@ -1,20 +1,46 @@
-import base64
+import contextlib
+import hashlib
+import math
+import numpy
 import os
-import sys
+import time
 import wx
+import zipfile
 from lxml import etree
 
 from doc.grid import Grid
+from doc.imagecache import ImageCache
+from doc.pixels import bitmapToArray, maskBitmap
+from doc.png import FORMATS, PngWriter
+from doc.strokes import Brush, BrushStroke, StrokeTable
 from util.events import EventProducer, event
+from util.rects import alignRect, unionRect
+
+ARCHIVE_EXT = '.gmz'
+MAP_WILDCARD = "Xml file (*.xml)|*.xml|Compact map (*%s)|*%s|All files (*.*)|*.*" % (ARCHIVE_EXT, ARCHIVE_EXT)
+# The png.FORMATS colour mode for each filter of EXPORT_WILDCARD.
+EXPORT_WILDCARD = "Colour png (*.png)|*.png|Grey png (*.png)|*.png|Black and white png (*.png)|*.png|All files (*.*)|*.*"
+EXPORT_COLORS = ('rgb', 'gray', 'mono', 'rgb')
+
+# Size of the pieces exportFile renders the map in.
+BAND_HEIGHT = 256
+BAND_WIDTH = 4096
+
+# x, y, rot, index into the archive's path table
+STROKE_RECORD = numpy.dtype([('x', '<i4'), ('y', '<i4'), ('rot', 'u1'), ('path', '<u4')])
 
 class MapDocument(EventProducer):
 	def __init__(self):
 		super(MapDocument, self).__init__()
 		self._brushDir = None
 		self._brush = None
-		self._strokes = []
+		self._strokes = StrokeTable()
+		self._batchDepth = 0
+		self._batchChange = None
 		self._dirty = False
 		self._lastSavePath = None
+		self._loadStart = None
+		self.loadTimings = {}
 		self.selectedStroke = None
 		self.grid = None
 		
@@ -23,49 +49,102 @@ class MapDocument(EventProducer):
 		self.onBrushChanged(self._brush)
 		return self._brush
 
+	@contextlib.contextmanager
+	def batch(self):
+		# Changes made inside a batch fire a single onMapChanged when the
+		# outermost batch exits, covering the union of their rects.
+		self._batchDepth += 1
+		try:
+			yield self
+		finally:
+			self._batchDepth -= 1
+			if ((self._batchDepth == 0) and (self._batchChange is not None)):
+				needsPaint, rect = self._batchChange
+				self._batchChange = None
+				self.onMapChanged(self, needsPaint, rect)
+
 	def strokeBrush(self, x, y):
+		rect = None
 		if (self._brush is not None):
-			self._strokes.append(self._brush.createStroke(x, y))
-		self.markDirty()
+			stroke = self._brush.createStroke(self._strokes, x, y)
+			self._addStroke(stroke)
+			rect = stroke.getRect()
+		self.markDirty(rect=rect)
 
 	def buildImage(self, includeGrid=False, useWhiteMask=True):
-		x, y, w, h = self._getBoundingRect()
+		x, y, w, h = self.getBoundingRect()
 		if ((w < 1) or (h < 1)):
 			return (x, y, None)
-		
-		if ((x != 0) or (y != 0)):
-			w -= x
-			h -= y
-			for stroke in self._strokes:
-				stroke.x -= x
-				stroke.y -= y
-		
-		bmp = wx.Bitmap.FromRGBA(int(w), int(h), 255, 255, 255, 255)
+		return (x, y, self.renderRegion((x, y, w, h), includeGrid, useWhiteMask))
+
+	def renderRegion(self, rect, includeGrid=False, useWhiteMask=True, scale=1.0):
+		# Below full size, rect is the map area to fit into a bitmap
+		# scale times its size, and need not be on whole pixels.
+		if (scale == 1.0):
+			rect = alignRect(rect)
+		x, y, w, h = rect
+		bmp = wx.Bitmap.FromRGBA(_scaledSize(w, scale), _scaledSize(h, scale), 255, 255, 255, 255)
 		
 		dc = wx.MemoryDC()
 		dc.SelectObject(bmp)
 		gc = wx.GraphicsContext.Create(dc)
+		self.drawRegion(gc, rect, includeGrid, scale)
+		del gc
+		dc.SelectObject(wx.NullBitmap)
+			
+		if (useWhiteMask and ImageCache.getInstance().getWhiteMask()):
+			maskBitmap(bmp)
+		return bmp
+	
+	def getRegionKey(self, rect, includeGrid=False):
+		# A hash of everything renderRegion draws in rect: the strokes
+		# overlapping it, bottom to top, the white mask and the grid.
+		sha = hashlib.sha1(repr(tuple(rect)))
+		sha.update('mask' if ImageCache.getInstance().getWhiteMask() else 'opaque')
+		self._strokes.hashRegion(rect, sha)
+		if (includeGrid and (self.grid is not None) and self.grid.enabled):
+			sha.update(repr((self.grid.getKey(), self.grid.renderAbove)))
+		return sha.hexdigest()
+	
+	def drawRegion(self, gc, rect, includeGrid=False, scale=1.0):
+		x, y, w, h = rect
+		drawGrid = (includeGrid and (self.grid is not None) and self.grid.enabled)
 		
-		if (includeGrid and self.grid.enabled and not self.grid.renderAbove):
-			self.grid.draw(gc, w, h)
+		if (drawGrid and not self.grid.renderAbove):
+			self._drawGridRegion(gc, rect, scale)
 		
-		for stroke in self._strokes:
-			stroke.draw(gc)
+		if (scale == 1.0):
+			gc.PushState()
+			gc.Translate(-x, -y)
+			for stroke in self.findStrokes(rect):
+				stroke.draw(gc)
+			gc.PopState()
+		else:
+			# Scaled strokes are drawn from pre-scaled copies of their tiles.
+			cache = ImageCache.getInstance()
+			for stroke in self.findStrokes(rect):
+				gc.DrawBitmap(cache.getScaledImage(stroke.tile, stroke.rot, scale), 
+				              (stroke.x - x) * scale, (stroke.y - y) * scale, 
+				              stroke.w * scale, stroke.h * scale)
 		
-		if (includeGrid and self.grid.enabled and self.grid.renderAbove):
-			self.grid.draw(gc, w, h)
+		if (drawGrid and self.grid.renderAbove):
+			self._drawGridRegion(gc, rect, scale)
 			
-		if (useWhiteMask and ImageCache.getInstance().getWhiteMask()):
-			img = bmp.ConvertToImage()
-			ImageCache.getInstance().setImageAlpha(img)
-			bmp = img.ConvertToBitmap()
-								
-		return (x, y, bmp)
+	def _drawGridRegion(self, gc, rect, scale=1.0):
+		# Grid lines are anchored to map coordinates, so shift the grid by
+		# the region's offset into its cell before drawing it.
+		x, y, w, h = rect
+		gc.PushState()
+		if (scale != 1.0):
+			gc.Scale(scale, scale)
+		gc.Translate(-(x % self.grid.w), -(y % self.grid.h))
+		self.grid.draw(gc, w + self.grid.w, h + self.grid.h)
+		gc.PopState()
 	
 	def selectStroke(self, x, y):
 		self.selectedStroke = self.findStroke(x, y)
 		if (self.selectedStroke is not None):
-			self._strokes.remove(self.selectedStroke)
+			self._strokes.lift(self.selectedStroke)
 		return self.selectedStroke
 				
 	def deleteSelectedStroke(self):
@@ -74,26 +153,99 @@ class MapDocument(EventProducer):
 		
 	def replaceSelectedStroke(self):
 		if (self.selectedStroke is not None):
-			self._strokes.append(self.selectedStroke)
+			self._addStroke(self.selectedStroke)
+			rect = self.selectedStroke.getRect()
 			self.selectedStroke = None
-			self.markDirty()
+			self.markDirty(rect=rect)
 
 	def deleteStroke(self, stroke):
 		if (self.selectedStroke == stroke):
 			self.selectedStroke = None
-		if (stroke in self._strokes):
-			self._strokes.remove(stroke)
+		self._removeStroke(stroke)
+		self.markDirty(rect=stroke.getRect())
+		
+	def createStroke(self, imgPath, x, y, rot=0):
+		# A stroke for this map that has not been added to it yet.
+		return self._strokes.create(imgPath, x, y, rot)
+		
+	def addStrokes(self, strokes):
+		with self.batch():
+			for stroke in strokes:
+				self._addStroke(stroke)
+				self.markDirty(rect=stroke.getRect())
+				
+	def removeStrokes(self, strokes):
+		strokes = set(strokes)
+		if (self.selectedStroke in strokes):
+			self.selectedStroke = None
+		with self.batch():
+			for stroke in strokes:
+				self._strokes.remove(stroke)
+				self.markDirty(rect=stroke.getRect())
+		
+	def moveStroke(self, stroke, x, y):
+		oldRect = stroke.getRect()
+		stroke.x = x
+		stroke.y = y
+		self.markDirty(rect=unionRect(oldRect, stroke.getRect()))
+		
+	def rotateStroke(self, stroke, direction=1):
+		oldRect = stroke.getRect()
+		stroke.rotate(direction)
+		self.markDirty(rect=unionRect(oldRect, stroke.getRect()))
+						
+	def translateStrokes(self, dx, dy):
+		self._strokes.translate(dx, dy)
 		self.markDirty()
 						
+	def hasStroke(self, stroke):
+		# True until the stroke is deleted or the map replaced, even while
+		# it is lifted out as the selection.
+		return (self._strokes.isCurrent(stroke) and bool(self._strokes.held[stroke.row]))
+	
 	def findStroke(self, x, y):
-		for stroke in self._strokes:
-			if (stroke.isInside(x, y)):
-				return stroke
-		return None
+		# Topmost stroke under the point.
+		return self._strokes.findAt(x, y)
+	
+	def findStrokes(self, rect):
+		# Strokes overlapping rect, bottom to top.
+		return self._strokes.query(rect)
+	
+	def snapshotRegion(self, rect):
+		return self._strokes.snapshot(rect)
+	
+	def _addStroke(self, stroke):
+		self._strokes.add(stroke)
+		
+	def _removeStroke(self, stroke):
+		self._strokes.remove(stroke)
+		
+	def _clearStrokes(self):
+		self.selectedStroke = None
+		self._strokes.clear()
+		ImageCache.getInstance().dropLegacy()
+		
+	def close(self):
+		# Lets go of the strokes and the tiles they hold, for documents
+		# that are done with, such as those loaded to export.
+		self._clearStrokes()
 		
-	def markDirty(self, needsPaint=True):
+	def markDirty(self, needsPaint=True, rect=None):
+		# rect is the map area affected by the change, or None if the
+		# whole map needs to be redrawn.
 		self._dirty = True
-		self.onMapChanged(self, needsPaint)
+		if (self._batchDepth == 0):
+			self.onMapChanged(self, needsPaint, rect)
+		elif (self._batchChange is None):
+			self._batchChange = (needsPaint, rect)
+		elif (needsPaint):
+			batchPaint, batchRect = self._batchChange
+			if (not batchPaint):
+				self._batchChange = (True, rect)
+			elif ((batchRect is not None) and (rect is not None)):
+				self._batchChange = (True, unionRect(batchRect, rect))
+			else:
+				self._batchChange = (True, None)
 		
 	def clearDirty(self):
 		self._dirty = False
@@ -102,7 +254,7 @@ class MapDocument(EventProducer):
 		if (self.checkForSave() == wx.ID_CANCEL):
 			return
 
-		self._strokes = []
+		self._clearStrokes()
 		self.grid = Grid(27, 27, 0, 0)
 		self.clearDirty()
 		
@@ -120,15 +272,29 @@ class MapDocument(EventProducer):
 		                    message="Choose a file",
 		                    defaultDir=os.getcwd(), 
 		                    defaultFile=defaultFile,
-		                    wildcard="Xml file (*.xml)|*.xml|All files (*.*)|*.*",
+		                    wildcard=MAP_WILDCARD,
 		                    style=wx.FD_OPEN | wx.FD_CHANGE_DIR)
 		if (dlg.ShowModal() == wx.ID_OK):
-			path = dlg.GetPath()
-			inFile = open(path, 'r')
-			node = etree.parse(inFile)
-			self.fromNode(node.getroot())
-			self._lastSavePath = path
+			self.loadFile(dlg.GetPath())
 		dlg.Destroy()
+		
+	def loadFile(self, path):
+		# loadTimings gets the seconds spent parsing, decoding and masking,
+		# and until the first finished tile is drawn.
+		self._loadStart = time.time()
+		self.loadTimings = {'decode': 0.0, 'mask': 0.0, 'prefetch': 0.0}
+		if (zipfile.is_zipfile(path)):
+			self.fromArchive(path)
+		else:
+			self.fromXmlFile(path)
+		self.loadTimings['parse'] = (time.time() - self._loadStart) - self.loadTimings['prefetch']
+		self._lastSavePath = path
+		
+	def markFirstPaint(self):
+		if (self._loadStart is not None):
+			self.loadTimings['firstPaint'] = time.time() - self._loadStart
+			self._loadStart = None
+			self.onMapLoaded(self.loadTimings)
 			
 	def checkForSave(self):
 		retVal = wx.YES
@@ -157,17 +323,20 @@ class MapDocument(EventProducer):
 		                    message="Save canvas as ...", 
 		                    defaultDir=os.getcwd(), 
 		                    defaultFile=defaultFile, 
-		                    wildcard="Xml file (*.xml)|*.xml|All files (*.*)|*.*",
+		                    wildcard=MAP_WILDCARD,
 		                    style=wx.FD_SAVE)
 		if dlg.ShowModal() == wx.ID_OK:
 			self._doSave(dlg.GetPath())
 		dlg.Destroy()
 	
 	def _doSave(self, path):
-		node = self.toNode()
-		strNode = etree.tostring(node, pretty_print=True)
-		outFile = open(path, 'w')
-		outFile.write(strNode)
+		if (path.lower().endswith(ARCHIVE_EXT)):
+			self.toArchive(path)
+		else:
+			node = self.toNode()
+			strNode = etree.tostring(node, pretty_print=True)
+			outFile = open(path, 'w')
+			outFile.write(strNode)
 		self.clearDirty()
 		self._lastSavePath = path
 		
@@ -175,13 +344,66 @@ class MapDocument(EventProducer):
 		dlg = wx.FileDialog(wx.GetApp().mainWindow,
 		                    message="Export canvas to ....",
 		                    defaultDir=os.getcwd(), 
-		                    wildcard="Png file (*.png)|*.png|All files (*.*)|*.*",
+		                    wildcard=EXPORT_WILDCARD,
 		                    style=wx.FD_SAVE)
 		if dlg.ShowModal() == wx.ID_OK:
-			path = dlg.GetPath()
-			x, y, bmp = self.buildImage(True, False)
-			bmp.SaveFile(path, wx.BITMAP_TYPE_PNG)
+			self.exportFile(dlg.GetPath(), color=EXPORT_COLORS[dlg.GetFilterIndex()])
 		dlg.Destroy()
+		
+	def exportFile(self, path, scale=1.0, maxSize=None, color='rgb'):
+		# Rendered and written a band at a time.  maxSize caps the longer
+		# side in pixels, and color is one of png.FORMATS.
+		scale = self.getExportScale(scale, maxSize)
+		bands = self.getExportBands(scale)
+		if (bands is None):
+			return False
+		w, h = self.getExportSize(scale)
+		writer = PngWriter(path, w, h, *FORMATS[color])
+		try:
+			for rect in bands:
+				writer.write(self.renderBand(rect, scale, color))
+		finally:
+			writer.close()
+		return True
+		
+	def getExportRect(self):
+		return alignRect(self.getBoundingRect())
+	
+	def getExportScale(self, scale=1.0, maxSize=None):
+		if (maxSize is not None):
+			x, y, w, h = self.getExportRect()
+			scale = min(scale, maxSize / float(max(w, h, 1)))
+		return scale
+	
+	def getExportSize(self, scale=1.0):
+		x, y, w, h = self.getExportRect()
+		return (_scaledSize(w, scale), _scaledSize(h, scale))
+	
+	def getExportBands(self, scale=1.0, bandHeight=BAND_HEIGHT):
+		# Map rects covering the exported image, top to bottom, each
+		# bandHeight image rows tall, or None if the map is empty.
+		x, y, w, h = self.getExportRect()
+		if ((w < 1) or (h < 1)):
+			return None
+		imgH = _scaledSize(h, scale)
+		return [(x, y + (top / scale), w, min(bandHeight, imgH - top) / scale) for top in xrange(0, imgH, bandHeight)]
+	
+	def renderBand(self, rect, scale=1.0, color='rgb'):
+		# An (h, w, 3) array of rect as exportFile draws it, or (h, w) for
+		# the 'gray' and 'mono' modes.
+		x, y, w, h = rect
+		imgW = _scaledSize(w, scale)
+		pixels = numpy.empty((_scaledSize(h, scale), imgW, 3), dtype=numpy.uint8)
+		for left in xrange(0, imgW, BAND_WIDTH):
+			bmp = self.renderRegion((x + (left / scale), y, min(BAND_WIDTH, imgW - left) / scale, h), True, False, scale)
+			pixels[:, left:left + bmp.GetWidth()] = bitmapToArray(bmp)[:, :, :3]
+		if (color == 'rgb'):
+			return pixels
+		gray = pixels.sum(axis=2, dtype=numpy.uint16)
+		gray //= 3
+		if (color == 'mono'):
+			return (gray >= 128)
+		return gray.astype(numpy.uint8)
 	
 	def toNode(self):
 		rootNode = etree.Element('map')
@@ -191,19 +413,21 @@ class MapDocument(EventProducer):
 		# grid
 		rootNode.append(self.grid.toNode())
 		
+		# image data, ahead of the strokes so that fromXmlFile knows every
+		# tile's size by the time it reaches them
+		rootNode.append(ImageCache.getInstance().toNode())
+		
 		# strokes
 		strokeRoot = etree.Element('strokes')
 		for stroke in self._strokes:
 			strokeRoot.append(stroke.toNode())
 		rootNode.append(strokeRoot)
-
-		# image data
-		rootNode.append(ImageCache.getInstance().toNode())
 		
 		return rootNode
 			
 	def fromNode(self, rootNode):
 		self.setBrushDir(rootNode.get('brushDir'))
+		self._clearStrokes()
 
 		# image data
 		imagesNode = rootNode.find('images')
@@ -211,12 +435,13 @@ class MapDocument(EventProducer):
 			ImageCache.getInstance().fromNode(imagesNode)
 			
 		# strokes
-		self._strokes = []
 		strokesNode = rootNode.find('strokes')
 		if (strokesNode is not None):
+			parsed = _ParsedStrokes()
 			for strokeNode in strokesNode:
 				if (strokeNode.tag == 'stroke'):
-					self._strokes.append(BrushStroke.fromNode(strokeNode))
+					parsed.add(*BrushStroke.argsFromNode(strokeNode))
+			self._addParsedStrokes(parsed.paths, parsed.pathIds, parsed.xs, parsed.ys, parsed.rots)
 					
 		# grid
 		gridNode = rootNode.find('grid')
@@ -225,35 +450,138 @@ class MapDocument(EventProducer):
 				
 		self.onNewMap(self)
 		self.onGridChanged(self.grid)
+		
+	def fromXmlFile(self, path):
+		# Streams the file rather than building the whole tree, freeing
+		# each element once handled.
+		cache = ImageCache.getInstance()
+		self._clearStrokes()
+		parsed = _ParsedStrokes()
+		for event, elem in etree.iterparse(path, events=('start', 'end')):
+			if (event == 'start'):
+				if (elem.tag == 'map'):
+					self.setBrushDir(elem.get('brushDir'))
+				elif (elem.tag == 'images'):
+					cache.setWhiteMask(elem.get('whiteMask') == 'true')
+				continue
+			
+			if (elem.tag == 'stroke'):
+				parsed.add(*BrushStroke.argsFromNode(elem))
+			elif (elem.tag == 'image'):
+				cache.addImageNode(elem)
+			elif (elem.tag == 'grid'):
+				self.grid.fromNode(elem)
+			else:
+				continue
+			
+			elem.clear()
+			while (elem.getprevious() is not None):
+				del elem.getparent()[0]
+				
+		self._addParsedStrokes(parsed.paths, parsed.pathIds, parsed.xs, parsed.ys, parsed.rots)
+				
+		self.onNewMap(self)
+		self.onGridChanged(self.grid)
+		
+	def toArchive(self, path):
+		# The compact format is a zip holding an xml manifest, a packed
+		# stroke table and one png per distinct tile.
+		archive = zipfile.ZipFile(path, 'w', zipfile.ZIP_DEFLATED)
+		
+		rootNode = etree.Element('map')
+		if (self._brushDir is not None):
+			rootNode.set('brushDir', self._brushDir)
+			
+		# grid
+		rootNode.append(self.grid.toNode())
+		
+		# strokes
+		strokeRoot = etree.Element('strokes', table='strokes.bin')
+		strokes = self._strokes
+		rows = strokes.getOrder()
+		pathTable = strokes.getPathTable()
+		used, pathIds = numpy.unique(strokes.path[rows], return_inverse=True)
+		for pathId in used:
+			imgPath, tile = pathTable[pathId]
+			pathNode = etree.Element('path', tile=tile)
+			pathNode.text = imgPath
+			strokeRoot.append(pathNode)
+		records = numpy.empty(len(rows), dtype=STROKE_RECORD)
+		records['x'] = strokes.x[rows]
+		records['y'] = strokes.y[rows]
+		records['rot'] = strokes.rot[rows]
+		records['path'] = pathIds
+		archive.writestr('strokes.bin', records.tostring())
+		rootNode.append(strokeRoot)
+		
+		# image data
+		rootNode.append(ImageCache.getInstance().toArchive(archive))
+		
+		archive.writestr('map.xml', etree.tostring(rootNode, pretty_print=True))
+		archive.close()
+		
+	def fromArchive(self, path):
+		archive = zipfile.ZipFile(path, 'r')
+		rootNode = etree.fromstring(archive.read('map.xml'))
+		self.setBrushDir(rootNode.get('brushDir'))
+		self._clearStrokes()
+
+		# image data
+		imagesNode = rootNode.find('images')
+		if (imagesNode is not None):
+			ImageCache.getInstance().fromArchive(imagesNode, archive)
+			
+		# strokes
+		strokesNode = rootNode.find('strokes')
+		if (strokesNode is not None):
+			paths = [(node.text, node.get('tile')) for node in strokesNode if (node.tag == 'path')]
+			records = numpy.frombuffer(archive.read(strokesNode.get('table')), dtype=STROKE_RECORD)
+			self._addParsedStrokes(paths, records['path'], records['x'], records['y'], records['rot'])
+				
+		# grid
+		gridNode = rootNode.find('grid')
+		if (gridNode is not None):
+			self.grid.fromNode(gridNode)
+		
+		archive.close()
+				
+		self.onNewMap(self)
+		self.onGridChanged(self.grid)
 
-	def _getBoundingRect(self):
+	def _addParsedStrokes(self, paths, pathIds, xs, ys, rots):
+		start = time.time()
+		decodeTime, maskTime = ImageCache.getInstance().prefetch(paths)
+		if (self._loadStart is not None):
+			self.loadTimings['decode'] += decodeTime
+			self.loadTimings['mask'] += maskTime
+			self.loadTimings['prefetch'] += time.time() - start
+		self._strokes.extend(paths, pathIds, xs, ys, rots)
+		ImageCache.getInstance().dropLegacy()
+		
+	def getBoundingRect(self):
 		x = 0
 		y = 0
-		w = 0
-		h = 0
+		right = 0
+		bottom = 0
 
-		if len(self._strokes) > 0:
-			x = sys.maxint
-			y = sys.maxint
-			for stroke in self._strokes:
-				sx, sy, sw, sh = stroke.getRect()
-				x = min(x, sx)
-				y = min(y, sy)
-				w = max(w, sx + sw)
-				h = max(h, sy + sh)
+		bounds = self._strokes.getBounds()
+		if (bounds is not None):
+			x, y, right, bottom = bounds
+			right = max(right, 0)
+			bottom = max(bottom, 0)
 
 		if ((self.grid is not None) and (self.grid.enabled)):
 			xMod = x % self.grid.w
 			x -= xMod
-			w += xMod
-			w += w % self.grid.w
+			right += xMod
+			right += right % self.grid.w
 			
 			yMod = y % self.grid.h
 			y -= yMod
-			h += yMod
-			h += h % self.grid.h			
+			bottom += yMod
+			bottom += bottom % self.grid.h			
 		
-		return (x, y, w, h)
+		return (x, y, right - x, bottom - y)
 	
 	def setBrushDir(self, brushDir):
 		self._brushDir = brushDir
@@ -268,7 +596,11 @@ class MapDocument(EventProducer):
 		pass
 
 	@event
-	def onMapChanged(self, doc, needsPaint):
+	def onMapLoaded(self, timings):
+		pass
+	
+	@event
+	def onMapChanged(self, doc, needsPaint, rect=None):
 		pass
 	
 	@event
@@ -280,191 +612,34 @@ class MapDocument(EventProducer):
 		pass
 
 
-class Brush(object):
-	ROT_NONE = 0
-	ROT_90 = 1
-	ROT_180 = 2
-	ROT_270 = 3
-
-	def __init__(self, imgPath):
-		self.imgPath = imgPath
-		self.rot = Brush.ROT_NONE
-		self._bmp = None
-
-	def _createBmp(self):
-		img = wx.Image(self.imgPath)
-		for i in xrange(self.rot):
-			img = img.Rotate90()
-		alphaBytes = chr(128) * (img.GetWidth() * img.GetHeight())
-		img.SetAlphaBuffer(alphaBytes)
-		return img.ConvertToBitmap()
-
-	def rotate(self, direction=1):
-		self.rot += direction
-		if (self.rot > Brush.ROT_270):
-			self.rot = Brush.ROT_NONE
-		if (self.rot < Brush.ROT_NONE):
-			self.rot = Brush.ROT_270
-		self._bmp = None
-
-	def draw(self, gc, x, y):
-		if (self._bmp is None):
-			self._bmp = self._createBmp()
-		w = self._bmp.GetWidth()
-		h = self._bmp.GetHeight()
-		gc.DrawBitmap(self._bmp, x - (w/2), y - (h/2), w, h)
-
-	def createStroke(self, x, y):
-		stroke = BrushStroke(self.imgPath, x, y, self.rot)
-		stroke.x -= stroke.w / 2
-		stroke.y -= stroke.h / 2
-		return stroke
-
-class BrushStroke(object):
-	def __init__(self, imgPath, x, y, rot):
-		self.imgPath = imgPath
-		self.rot = rot
-		self.x = x
-		self.y = y
-		
-		self._bmp = ImageCache.getInstance().getImage(self.imgPath, self.rot)
-		self.w = self._bmp.GetWidth()
-		self.h = self._bmp.GetHeight()
-		
-	def __del__(self):
-		ImageCache.getInstance().releaseImage(self.imgPath, self.rot)
-
-	def draw(self, gc):
-		self.drawTo(gc, self.x, self.y)
-		
-	def drawTo(self, gc, x, y):
-		gc.DrawBitmap(self._bmp, x, y, self.w, self.h)
-
-	def getRect(self):
-		return (self.x, self.y, self.w, self.h)	
-	
-	def isInside(self, x, y):
-		return ( (x >= self.x) and 
-		         (y >= self.y) and
-		         (x < (self.x + self. w)) and 
-		         (y < (self.y + self.h)) )
-	
-	def rotate(self, direction=1):
-		ImageCache.getInstance().releaseImage(self.imgPath, self.rot)
-		self.rot += direction
-		if (self.rot > Brush.ROT_270):
-			self.rot = Brush.ROT_NONE
-		if (self.rot < Brush.ROT_NONE):
-			self.rot = Brush.ROT_270
-		self._bmp = ImageCache.getInstance().getImage(self.imgPath, self.rot)
-	
-	def toNode(self):
-		node = etree.Element("stroke")
-		node.set('imgPath', self.imgPath)
-		node.set('x', '%d' % self.x)
-		node.set('y', '%d' % self.y)
-		node.set('rot', str(self.rot))
-		return node
-	
-	@staticmethod
-	def fromNode(node):
-		imgPath = node.get('imgPath')
-		x = int(node.get('x'))
-		y = int(node.get('y'))
-		rot = int(node.get('rot'))
-		return BrushStroke(imgPath, x, y, rot)
-
-
-class ImageCache(object):
-	__instance = None
+def _scaledSize(length, scale):
+	# Pixels needed to cover length map units at scale, ignoring the
+	# rounding error of bands whose map height is length / scale.
+	return max(1, int(math.ceil(round(length * scale, 6))))
 
-	@staticmethod
-	def getInstance():
-		if ImageCache.__instance is None:
-			ImageCache.__instance = ImageCache()
-		return ImageCache.__instance
 
+class _ParsedStrokes(object):
+	"""
+	Stroke attributes gathered while parsing a map, as the columns that
+	StrokeTable.extend takes.
+	"""
 	def __init__(self):
-		self._cache = {}
-		self._bmpCache = {}
-		self._whiteMask = True
-		
-	def setWhiteMask(self, whiteMask):
-		if (self._whiteMask != whiteMask):
-			self._whiteMask = whiteMask
-			self._bmpCache.clear()
-			for key, val in self._cache.iteritems():
-				if (self._whiteMask):
-					self.setImageAlpha(val[0])
-				else:
-					self.clearImageAlpha(val[0])
-					
-	def getWhiteMask(self):
-		return self._whiteMask
-
-	def getImage(self, imgPath, rot):
-		key = "%s_%s" % (imgPath, rot)
-		if (not self._cache.has_key(key)):
-			self._cache[key] = [self._loadImage(imgPath, rot), 1]
-		else:
-			self._cache[key][1] += 1
-		if (not self._bmpCache.has_key(key)):
-			self._bmpCache[key] = self._cache[key][0].ConvertToBitmap()						
-		return self._bmpCache[key]
-	
-	def releaseImage(self, imgPath, rot):
-		key = "%s_%s" % (imgPath, rot)
-		if (key in self._cache):
-			self._cache[key][1] -= 1
-			if (self._cache[key][1] == 0):
-				del self._cache[key]
-				
-	def toNode(self):
-		node = etree.Element("images")
-		if (self._whiteMask):
-			node.set('whiteMask', 'true')
-		for key, val in self._cache.iteritems():
-			img, count = val
-			subNode = etree.Element("image")
-			subNode.set('path', key)
-			subNode.set('w', '%s' % img.GetWidth())
-			subNode.set('h', '%s' % img.GetHeight())
-			subNode.text = base64.b64encode(img.GetData())
-			node.append(subNode)
-		return node
-	
-	def fromNode(self, node):
-		self.setWhiteMask(node.get('whiteMask') == 'true')
-		for subNode in node:
-			path = subNode.get('path')
-			if (path not in self._cache):
-				w = int(subNode.get('w'))
-				h = int(subNode.get('h'))
-				img = wx.Image(w, h)
-				img.SetData(base64.b64decode(subNode.text))
-				if (self._whiteMask):
-					self.setImageAlpha(img)
-				else:
-					self.clearImageAlpha(img)
-				self._cache[path] = [img, 0]
-
-	def _loadImage(self, imgPath, rot):
-		img = wx.Image(imgPath)
-		for i in xrange(rot):
-			img = img.Rotate90()
-		if (self._whiteMask):
-			self.setImageAlpha(img)
-		return img
-	
-	def setImageAlpha(self, img):
-		data = img.GetData()
-		alpha = ''
-		for i in xrange(len(data) / 3):
-			alpha += chr(255 - ((data[i*3] + data[i*3+1] + data[i*3+2]) / 3))
-		img.SetAlpha(alpha)
-		
-	def clearImageAlpha(self, img):
-		data = img.GetData()
-		alpha = chr(255) * (len(data) / 3)
-		img.SetAlpha(alpha)
-	
+		self.paths = []
+		self.pathIds = []
+		self.xs = []
+		self.ys = []
+		self.rots = []
+		self._ids = {}
+		
+	def add(self, imgPath, x, y, rot, tile=None):
+		key = (imgPath, tile)
+		pathId = self._ids.get(key)
+		if (pathId is None):
+			pathId = self._ids[key] = len(self.paths)
+			self.paths.append(key)
+		self.pathIds.append(pathId)
+		self.xs.append(x)
+		self.ys.append(y)
+		self.rots.append(rot)
+		
+		
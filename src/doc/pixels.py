@@ -0,0 +1,113 @@
+import numpy
+import wx
+
+class PixelBuffer(object):
+	"""
+	Decoded pixels as a NumPy array, (h, w, 3) RGB or (h, w) grey, often a
+	view onto storage the buffer keeps alive.  Treat it as read-only.
+	"""
+	def __init__(self, pixels, owner=None):
+		self.pixels = pixels
+		self._owner = owner
+		
+	@staticmethod
+	def fromImage(img):
+		w = img.GetWidth()
+		h = img.GetHeight()
+		return PixelBuffer(numpy.frombuffer(img.GetDataBuffer(), dtype=numpy.uint8).reshape(h, w, 3), img)
+	
+	def GetWidth(self):
+		return self.pixels.shape[1]
+	
+	def GetHeight(self):
+		return self.pixels.shape[0]
+	
+	def isGray(self):
+		return (self.pixels.ndim == 2)
+	
+
+def rgbArray(buf):
+	# View an interleaved RGB buffer as an (n, 3) array without copying it.
+	return numpy.frombuffer(buf, dtype=numpy.uint8).reshape(-1, 3)
+
+def whiteAlpha(buf, out=None):
+	# Alpha of 255 - mean(R, G, B) for every pixel of an RGB buffer, so
+	# white becomes fully transparent and black fully opaque.
+	return maskAlpha(rgbArray(buf), out)
+
+def maskAlpha(pixels, out=None):
+	# whiteAlpha for an RGB or RGBA array of any shape; out may be a view,
+	# such as the alpha channel of pixels itself.
+	total = pixels[..., :3].sum(axis=-1, dtype=numpy.uint16)
+	total //= 3
+	if (out is None):
+		out = numpy.empty(total.shape, dtype=numpy.uint8)
+	numpy.subtract(255, total, out=out, casting='unsafe')
+	return out
+
+def bitmapToArray(bmp):
+	# An (h, w, 4) array of the bitmap's unpremultiplied RGBA pixels.
+	arr = numpy.empty((bmp.GetHeight(), bmp.GetWidth(), 4), dtype=numpy.uint8)
+	bmp.CopyToBuffer(arr, wx.BitmapBufferFormat_RGBA)
+	return arr
+
+def arrayToBitmap(arr):
+	h, w = arr.shape[:2]
+	return wx.Bitmap.FromBufferRGBA(w, h, numpy.ascontiguousarray(arr))
+
+def maskBitmap(bmp):
+	# Applies the white mask to a bitmap in place, through one RGBA array.
+	arr = bitmapToArray(bmp)
+	maskAlpha(arr, arr[:, :, 3])
+	bmp.CopyFromBuffer(arr, wx.BitmapBufferFormat_RGBA)
+
+def blankArray(w, h):
+	# Transparent white, which is what the white mask turns white into.
+	arr = numpy.empty((h, w, 4), dtype=numpy.uint8)
+	arr[:, :, :3] = 255
+	arr[:, :, 3] = 0
+	return arr
+
+def imageToArray(img):
+	# An (h, w, 4) copy of a wx.Image's RGB and alpha.
+	w = img.GetWidth()
+	h = img.GetHeight()
+	alpha = None
+	if (img.HasAlpha()):
+		alpha = numpy.frombuffer(img.GetAlphaBuffer(), dtype=numpy.uint8).reshape(h, w)
+	return rgbToArray(PixelBuffer.fromImage(img).pixels, alpha)
+
+def rgbToArray(rgb, alpha=None):
+	# An (h, w, 4) array of (h, w, 3) RGB and an (h, w) alpha, or opaque.
+	h, w = rgb.shape[:2]
+	arr = numpy.empty((h, w, 4), dtype=numpy.uint8)
+	arr[:, :, :3] = rgb
+	if (alpha is not None):
+		arr[:, :, 3] = alpha
+	else:
+		arr[:, :, 3] = 255
+	return arr
+
+def arrayToImage(arr):
+	h, w = arr.shape[:2]
+	return wx.Image(w, h, numpy.ascontiguousarray(arr[:, :, :3]), numpy.ascontiguousarray(arr[:, :, 3]))
+
+def grayLevels(rgb):
+	# An (h, w) array of an (h, w, 3) array's grey levels if every pixel's
+	# colour channels are equal, so nothing is lost, or None if not.
+	gray = rgb[:, :, 0]
+	if ((rgb[:, :, 1] != gray).any() or (rgb[:, :, 2] != gray).any()):
+		return None
+	return gray.copy()
+
+def grayToArray(gray, whiteMask):
+	# An (h, w, 4) RGBA array of an (h, w) grey array, masked the way
+	# whiteAlpha would mask it or opaque.
+	h, w = gray.shape
+	arr = numpy.empty((h, w, 4), dtype=numpy.uint8)
+	arr[:, :, :3] = gray[:, :, numpy.newaxis]
+	if (whiteMask):
+		numpy.subtract(255, gray, out=arr[:, :, 3])
+	else:
+		arr[:, :, 3] = 255
+	return arr
@@ -0,0 +1,61 @@
+import numpy
+import struct
+import zlib
+
+SIGNATURE = '\x89PNG\r\n\x1a\n'
+COLOR_TYPES = {1: 0, 3: 2, 4: 6}
+# (channels, bit depth) for each export colour mode.
+FORMATS = {'rgb': (3, 8), 
+           'gray': (1, 8), 
+           'mono': (1, 1)}
+# Each row is stored as its difference from the row above, which keeps
+# the long runs of flat colour in map art compressing well.
+FILTER_UP = 2
+
+class PngWriter(object):
+	"""
+	Writes an 8 bit grey, RGB or RGBA png, or a 1 bit black and white one,
+	a band of rows at a time.
+	"""
+	def __init__(self, path, w, h, channels=3, bitDepth=8, level=6):
+		self._w = w
+		self._channels = channels
+		self._bitDepth = bitDepth
+		self._rowBytes = ((w * channels * bitDepth) + 7) // 8
+		self._lastRow = numpy.zeros(self._rowBytes, dtype=numpy.uint8)
+		self._compressor = zlib.compressobj(level)
+		self._ownsFile = isinstance(path, basestring)
+		if (self._ownsFile):
+			self._file = open(path, 'wb')
+		else:
+			self._file = path
+		self._file.write(SIGNATURE)
+		self._writeChunk('IHDR', struct.pack('>IIBBBBB', w, h, bitDepth, COLOR_TYPES[channels], 0, 0, 0))
+
+	def write(self, rows):
+		if (self._bitDepth == 1):
+			rows = numpy.packbits(rows.reshape(len(rows), self._w) != 0, axis=1)
+		else:
+			rows = rows.reshape(len(rows), self._rowBytes)
+		filtered = numpy.empty((len(rows), self._rowBytes + 1), dtype=numpy.uint8)
+		filtered[:, 0] = FILTER_UP
+		numpy.subtract(rows[0], self._lastRow, out=filtered[0, 1:])
+		numpy.subtract(rows[1:], rows[:-1], out=filtered[1:, 1:])
+		self._lastRow = rows[-1].copy()
+		data = self._compressor.compress(filtered.tostring())
+		if (len(data) > 0):
+			self._writeChunk('IDAT', data)
+
+	def close(self):
+		try:
+			self._writeChunk('IDAT', self._compressor.flush())
+			self._writeChunk('IEND', '')
+		finally:
+			if (self._ownsFile):
+				self._file.close()
+
+	def _writeChunk(self, tag, data):
+		self._file.write(struct.pack('>I', len(data)))
+		self._file.write(tag)
+		self._file.write(data)
+		self._file.write(struct.pack('>I', zlib.crc32(tag + data) & 0xffffffff))
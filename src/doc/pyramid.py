@@ -0,0 +1,100 @@
+import math
+import os
+from lxml import etree
+
+from util.files import replaceFile
+
+TILE_SIZE = 256
+DZI_NAMESPACE = 'http://schemas.microsoft.com/deepzoom/2008'
+
+class Pyramid(object):
+	"""
+	The layout of a Deep Zoom (DZI) image pyramid over a map's export
+	rect, stored as <name>_files/<level>/<col>_<row>.png beside the
+	<name>.dzi descriptor, with a manifest of what each tile shows.
+	"""
+	def __init__(self, path, rect, tileSize=TILE_SIZE):
+		self._path = path
+		self._filesDir = os.path.splitext(path)[0] + '_files'
+		self._rect = rect
+		self._tileSize = tileSize
+		self._maxLevel = int(math.ceil(math.log(max(rect[2], rect[3]), 2)))
+
+	def getTiles(self):
+		# (level, col, row) for every tile, coarsest level first.
+		tiles = []
+		for level in xrange(self._maxLevel + 1):
+			w, h = self._getLevelSize(level)
+			for row in xrange(int(math.ceil(h / float(self._tileSize)))):
+				for col in xrange(int(math.ceil(w / float(self._tileSize)))):
+					tiles.append((level, col, row))
+		return tiles
+
+	def getTileRect(self, level, col, row):
+		# The map rect a tile shows.
+		x, y, w, h = self._rect
+		span = self._tileSize << (self._maxLevel - level)
+		left = col * span
+		top = row * span
+		return (x + left, y + top, min(span, w - left), min(span, h - top))
+
+	def getScale(self, level):
+		return 1.0 / (1 << (self._maxLevel - level))
+
+	def getTilePath(self, level, col, row):
+		return os.path.join(self._filesDir, '%d' % level, '%d_%d.png' % (col, row))
+
+	def makeDirs(self):
+		for level in xrange(self._maxLevel + 1):
+			path = os.path.join(self._filesDir, '%d' % level)
+			if (not os.path.isdir(path)):
+				os.makedirs(path)
+
+	def writeDescriptor(self):
+		node = etree.Element('Image', nsmap={None: DZI_NAMESPACE})
+		node.set('TileSize', '%d' % self._tileSize)
+		node.set('Overlap', '0')
+		node.set('Format', 'png')
+		sizeNode = etree.SubElement(node, 'Size')
+		sizeNode.set('Width', '%d' % self._rect[2])
+		sizeNode.set('Height', '%d' % self._rect[3])
+		etree.ElementTree(node).write(self._path, xml_declaration=True, encoding='UTF-8', pretty_print=True)
+
+	def loadManifest(self):
+		# {(level, col, row): key} from the last export, or {}.
+		manifest = {}
+		try:
+			f = open(self._getManifestPath(), 'r')
+		except IOError:
+			return manifest
+		try:
+			for line in f:
+				tile, key = line.split()
+				level, col, row = [int(value) for value in tile.split('/')]
+				manifest[(level, col, row)] = key
+		finally:
+			f.close()
+		return manifest
+
+	def saveManifest(self, manifest, oldManifest=None):
+		# Tiles only the old manifest lists belong to a pyramid of another
+		# size, and are removed.
+		if (oldManifest is not None):
+			for tile in oldManifest:
+				path = self.getTilePath(*tile)
+				if ((tile not in manifest) and os.path.exists(path)):
+					os.remove(path)
+		with replaceFile(self._getManifestPath()) as tmpPath:
+			f = open(tmpPath, 'w')
+			try:
+				for tile in sorted(manifest):
+					f.write('%d/%d/%d %s\n' % (tile + (manifest[tile],)))
+			finally:
+				f.close()
+
+	def _getLevelSize(self, level):
+		scale = 1 << (self._maxLevel - level)
+		return (-(-self._rect[2] // scale), -(-self._rect[3] // scale))
+
+	def _getManifestPath(self):
+		return os.path.join(self._filesDir, 'manifest.txt')
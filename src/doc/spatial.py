@@ -0,0 +1,81 @@
+import math
+import numpy
+
+CELL_SIZE = 256
+# Cell coordinates are offset by this before being packed into keys, so
+# maps may reach +/- CELL_OFFSET cells from the origin.
+CELL_OFFSET = 1 << 24
+# The grid is rebuilt once more rows than this, or than one in
+# REBUILD_RATIO of those it holds, have changed since it was built.
+MIN_REBUILD = 256
+REBUILD_RATIO = 16
+
+class StrokeIndex(object):
+	"""
+	A uniform grid of buckets over map coordinates, used to find the rows
+	of a StrokeTable near a point or rect without scanning every row.
+	"""
+	def __init__(self, cellSize=CELL_SIZE):
+		self._cellSize = cellSize
+		self.clear()
+
+	def clear(self):
+		self._keys = numpy.zeros(0, dtype=numpy.int64)
+		self._rows = numpy.zeros(0, dtype=numpy.intp)
+		self._changed = set()
+		self._stale = False
+
+	def touch(self, row):
+		# A row has moved, been resized or been added to the map.
+		self._changed.add(row)
+
+	def invalidate(self):
+		# Many rows have changed at once.
+		self._stale = True
+
+	def candidates(self, table, rect):
+		# Rows of table that may overlap rect, or None if the rect covers
+		# more cells than there are rows.
+		if ( self._stale or 
+		     (len(self._changed) > max(MIN_REBUILD, len(self._rows) // REBUILD_RATIO)) ):
+			self._build(table)
+		# Scaled exports ask for rects with fractional edges; the last
+		# cell is the one holding the last whole pixel the rect touches.
+		x, y, w, h = rect
+		size = self._cellSize
+		x0 = int(math.floor(x)) // size
+		y0 = int(math.floor(y)) // size
+		x1 = max(x0, (int(math.ceil(x + w)) - 1) // size)
+		y1 = max(y0, (int(math.ceil(y + h)) - 1) // size)
+		if ((x1 - x0 + 1) * (y1 - y0 + 1) > len(table)):
+			return None
+		parts = [numpy.fromiter(self._changed, dtype=numpy.intp, count=len(self._changed))]
+		for cx in xrange(x0, x1 + 1):
+			start = numpy.searchsorted(self._keys, _packKey(cx, y0))
+			end = numpy.searchsorted(self._keys, _packKey(cx, y1), 'right')
+			parts.append(self._rows[start:end])
+		return numpy.unique(numpy.concatenate(parts))
+
+	def _build(self, table):
+		n = len(table.x)
+		rows = numpy.flatnonzero(table.alive[:n] & (table.w[:n] > 0) & (table.h[:n] > 0))
+		size = self._cellSize
+		x0 = table.x[rows].astype(numpy.int64) // size
+		y0 = table.y[rows].astype(numpy.int64) // size
+		columns = (table.x[rows] + table.w[rows] - 1) // size - x0 + 1
+		counts = columns * ((table.y[rows] + table.h[rows] - 1) // size - y0 + 1)
+		
+		# One key per cell each row covers, walking its cells row by row.
+		owners = numpy.repeat(numpy.arange(len(rows)), counts)
+		offsets = numpy.arange(len(owners)) - numpy.repeat(numpy.cumsum(counts) - counts, counts)
+		keys = _packKey(x0[owners] + offsets % columns[owners], 
+		                y0[owners] + offsets // columns[owners])
+		order = numpy.argsort(keys)
+		self._keys = keys[order]
+		self._rows = rows[owners[order]]
+		self._changed = set()
+		self._stale = False
+
+
+def _packKey(cx, cy):
+	return ((cx + CELL_OFFSET) << 26) + (cy + CELL_OFFSET)
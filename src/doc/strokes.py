@@ -0,0 +1,413 @@
+import math
+import numpy
+import wx
+from lxml import etree
+
+from doc.compositor import StrokeSnapshot
+from doc.imagecache import ImageCache
+from doc.spatial import StrokeIndex
+from util.rects import isEmpty
+
+class Brush(object):
+	ROT_NONE = 0
+	ROT_90 = 1
+	ROT_180 = 2
+	ROT_270 = 3
+
+	def __init__(self, imgPath):
+		self.imgPath = imgPath
+		self.rot = Brush.ROT_NONE
+		self._bmp = None
+
+	def _createBmp(self):
+		img = wx.Image(self.imgPath)
+		for i in xrange(self.rot):
+			img = img.Rotate90()
+		alphaBytes = chr(128) * (img.GetWidth() * img.GetHeight())
+		img.SetAlphaBuffer(alphaBytes)
+		return img.ConvertToBitmap()
+
+	def rotate(self, direction=1):
+		self.rot += direction
+		if (self.rot > Brush.ROT_270):
+			self.rot = Brush.ROT_NONE
+		if (self.rot < Brush.ROT_NONE):
+			self.rot = Brush.ROT_270
+		self._bmp = None
+
+	def getSize(self):
+		if (self._bmp is None):
+			self._bmp = self._createBmp()
+		return (self._bmp.GetWidth(), self._bmp.GetHeight())
+
+	def draw(self, gc, x, y):
+		w, h = self.getSize()
+		gc.DrawBitmap(self._bmp, x - (w/2), y - (h/2), w, h)
+
+	def createStroke(self, strokes, x, y):
+		stroke = strokes.create(self.imgPath, x, y, self.rot)
+		stroke.x -= stroke.w / 2
+		stroke.y -= stroke.h / 2
+		return stroke
+
+
+class StrokeTable(object):
+	"""
+	Column storage for the strokes of a map, one row per stroke, with
+	BrushStroke objects as views onto rows.  Each row holds a reference to
+	its tile until the row is reused by a later stroke, so a removed stroke
+	can be put back whether or not its tile could be loaded again.  Reused
+	rows get a new generation, so views of the removed stroke go stale.
+	"""
+	INITIAL_ROWS = 1024
+	COLUMNS = (('x', numpy.int32),
+	           ('y', numpy.int32),
+	           ('w', numpy.int32),
+	           ('h', numpy.int32),
+	           ('rot', numpy.uint8),
+	           ('tile', numpy.int32),
+	           ('path', numpy.int32),
+	           ('z', numpy.int64),
+	           ('alive', numpy.bool_),
+	           ('held', numpy.bool_),
+	           ('gen', numpy.uint32))
+	
+	def __init__(self):
+		self._rows = 0
+		self._nextGen = 1
+		self._free = []
+		self.held = numpy.zeros(0, dtype=numpy.bool_)
+		self._index = StrokeIndex()
+		self.clear()
+		
+	def clear(self):
+		self._release(numpy.concatenate([numpy.flatnonzero(self.held[:self._rows]), 
+		                                 numpy.array(self._free, dtype=numpy.intp)]))
+		self._index.clear()
+		self._free = []
+		for name, dtype in StrokeTable.COLUMNS:
+			setattr(self, name, numpy.zeros(StrokeTable.INITIAL_ROWS, dtype=dtype))
+		self._rows = 0
+		self._live = 0
+		self._nextZ = 0
+		
+		self._paths = []
+		self._pathIds = {}
+		self._tiles = []
+		self._tileIds = {}
+		self._tileSizes = []
+		self._tileKeys = {}
+		
+	def __len__(self):
+		return self._live
+	
+	def __contains__(self, stroke):
+		return (self.isCurrent(stroke) and bool(self.alive[stroke.row]))
+	
+	def isCurrent(self, stroke):
+		# False once the stroke's row has gone to another stroke or the
+		# table has been cleared.
+		return ( (stroke._table is self) and (stroke.row < self._rows) and 
+		         (self.gen[stroke.row] == stroke.gen) )
+	
+	def __iter__(self):
+		for row in self.getOrder():
+			yield BrushStroke(self, row)
+			
+	def create(self, imgPath, x, y, rot, tile=None):
+		pathId = self._internPath(imgPath, tile, 1)
+		row = self._allocate(1)
+		self._setRows(row, pathId, x, y, rot)
+		self.held[row] = True
+		return BrushStroke(self, row)
+	
+	def extend(self, paths, pathIds, xs, ys, rots):
+		# paths is a list of (imgPath, tile) pairs that pathIds index.
+		count = len(pathIds)
+		if (count == 0):
+			return
+		pathIds = numpy.asarray(pathIds, dtype=numpy.intp)
+		counts = numpy.bincount(pathIds, minlength=len(paths))
+		lookup = numpy.array([self._internPath(imgPath, tile, int(n)) for (imgPath, tile), n in zip(paths, counts)], dtype=numpy.int32)
+		rows = self._allocate(count)
+		rows = slice(rows, rows + count)
+		self._setRows(rows, lookup[pathIds], xs, ys, rots)
+		self.held[rows] = True
+		self.z[rows] = numpy.arange(self._nextZ, self._nextZ + count)
+		self.alive[rows] = True
+		self._nextZ += count
+		self._live += count
+		self._index.invalidate()
+	
+	def add(self, stroke):
+		# A removed stroke can be put back until its row is reused.
+		if (not self.isCurrent(stroke)):
+			return
+		if (not self.held[stroke.row]):
+			self._free.remove(stroke.row)
+			self.held[stroke.row] = True
+		if (not self.alive[stroke.row]):
+			self.alive[stroke.row] = True
+			self._live += 1
+		self.z[stroke.row] = self._nextZ
+		self._nextZ += 1
+		self._index.touch(stroke.row)
+		
+	def lift(self, stroke):
+		# Takes a stroke out of the map, keeping its tile and row.
+		if (self.isCurrent(stroke) and self.alive[stroke.row]):
+			self.alive[stroke.row] = False
+			self._live -= 1
+		
+	def remove(self, stroke):
+		self.lift(stroke)
+		if (self.isCurrent(stroke) and self.held[stroke.row]):
+			self.held[stroke.row] = False
+			self._free.append(stroke.row)
+			
+	def touch(self, row):
+		self._index.touch(row)
+			
+	def getOrder(self, mask=None):
+		live = self.alive[:self._rows]
+		if (mask is not None):
+			live = live & mask
+		rows = numpy.flatnonzero(live)
+		return rows[numpy.argsort(self.z[rows])]
+		
+	def findAt(self, x, y):
+		rows = self._getCandidates((x, y, 1, 1))
+		mask = ( self.alive[rows] & 
+		         (self.x[rows] <= x) & (self.y[rows] <= y) & 
+		         (x < self.x[rows] + self.w[rows]) & (y < self.y[rows] + self.h[rows]) )
+		rows = rows[mask]
+		if (len(rows) == 0):
+			return None
+		return BrushStroke(self, rows[numpy.argmax(self.z[rows])])
+	
+	def query(self, rect):
+		return [BrushStroke(self, row) for row in self._queryRows(rect)]
+	
+	def snapshot(self, rect):
+		rows = self._queryRows(rect)
+		used, tileIds = numpy.unique(self.tile[rows], return_inverse=True)
+		cache = ImageCache.getInstance()
+		return StrokeSnapshot(self.x[rows], self.y[rows], self.rot[rows], tileIds,
+		                      [cache.getPixels(self._tiles[tile]) for tile in used],
+		                      cache.getWhiteMask())
+	
+	def hashRegion(self, rect, sha):
+		rows = self._queryRows(rect)
+		for column in (self.x, self.y, self.rot):
+			sha.update(column[rows].tostring())
+		sha.update(' '.join([self._tiles[tile] for tile in self.tile[rows]]))
+	
+	def _queryRows(self, rect):
+		if (isEmpty(rect)):
+			return numpy.zeros(0, dtype=numpy.intp)
+		x, y, w, h = rect
+		rows = self._getCandidates(rect)
+		mask = ( self.alive[rows] &
+		         (self.x[rows] < x + w) & (self.x[rows] + self.w[rows] > x) &
+		         (self.y[rows] < y + h) & (self.y[rows] + self.h[rows] > y) &
+		         (self.w[rows] > 0) & (self.h[rows] > 0) )
+		rows = rows[mask]
+		return rows[numpy.argsort(self.z[rows])]
+	
+	def _getCandidates(self, rect):
+		rows = self._index.candidates(self, rect)
+		if (rows is None):
+			return numpy.arange(self._rows)
+		return rows
+	
+	def getBounds(self):
+		if (self._live == 0):
+			return None
+		n = self._rows
+		live = self.alive[:n]
+		return (int(self.x[:n][live].min()),
+		        int(self.y[:n][live].min()),
+		        int((self.x[:n] + self.w[:n])[live].max()),
+		        int((self.y[:n] + self.h[:n])[live].max()))
+		
+	def translate(self, dx, dy):
+		live = self.alive[:self._rows]
+		self.x[:self._rows][live] += dx
+		self.y[:self._rows][live] += dy
+		self._index.invalidate()
+		
+	def getPath(self, row):
+		return self._paths[self.path[row]][0]
+	
+	def getTile(self, row):
+		return self._tiles[self.tile[row]]
+	
+	def getPathTable(self):
+		return [(imgPath, self._tiles[tile]) for imgPath, tile in self._paths]
+	
+	def _internPath(self, imgPath, tile=None, count=0):
+		# Paths are interned together with the tile they resolved to, so
+		# the same file can map to two tiles if it changed on disk.  Takes
+		# count references to the tile, loading it again if it was evicted.
+		key = (imgPath, tile)
+		pathId = self._pathIds.get(key)
+		if (pathId is not None):
+			tile = self._tiles[self._paths[pathId][1]]
+		tileId, w, h = ImageCache.getInstance().acquireImage(imgPath, Brush.ROT_NONE, tile, count)
+		if ((pathId is None) or (tileId != tile)):
+			tileIndex = self._tileIds.get(tileId)
+			if (tileIndex is None):
+				tileIndex = self._tileIds[tileId] = len(self._tiles)
+				self._tiles.append(tileId)
+				self._tileSizes.append((w, h))
+			pathId = self._pathIds.get((imgPath, tileId))
+			if (pathId is None):
+				pathId = len(self._paths)
+				self._paths.append((imgPath, tileIndex))
+				self._pathIds[(imgPath, tileId)] = pathId
+			self._pathIds[key] = pathId
+		return pathId
+	
+	def _release(self, rows):
+		if (len(rows) == 0):
+			return
+		counts = numpy.bincount(self.tile[rows])
+		cache = ImageCache.getInstance()
+		for tileIndex in numpy.flatnonzero(counts):
+			cache.releaseImage(self._tiles[tileIndex], int(counts[tileIndex]))
+			
+	def _allocate(self, count):
+		if ((count == 1) and self._free):
+			row = self._free.pop()
+			self._release(numpy.array([row]))
+			self.gen[row] = self._nextGen
+			self._nextGen += 1
+			return row
+		row = self._rows
+		if (row + count > len(self.x)):
+			size = len(self.x)
+			while (size < row + count):
+				size *= 2
+			for name, dtype in StrokeTable.COLUMNS:
+				column = numpy.zeros(size, dtype=dtype)
+				column[:row] = getattr(self, name)[:row]
+				setattr(self, name, column)
+		self._rows += count
+		self.gen[row:row + count] = numpy.arange(self._nextGen, self._nextGen + count)
+		self._nextGen += count
+		return row
+	
+	def _setRows(self, rows, pathIds, xs, ys, rots):
+		tiles = numpy.array([tile for imgPath, tile in self._paths], dtype=numpy.int32)[pathIds]
+		sizes = numpy.array(self._tileSizes, dtype=numpy.int32)[tiles]
+		rots = numpy.asarray(rots, dtype=numpy.uint8)
+		odd = (rots % 2).astype(numpy.bool_)
+		self.path[rows] = pathIds
+		self.tile[rows] = tiles
+		self.x[rows] = xs
+		self.y[rows] = ys
+		self.rot[rows] = rots
+		self.w[rows] = numpy.where(odd, sizes[..., 1], sizes[..., 0])
+		self.h[rows] = numpy.where(odd, sizes[..., 0], sizes[..., 1])
+
+	
+def _strokeColumn(name):
+	def get(self):
+		return int(getattr(self._table, name)[self.row])
+	def set(self, value):
+		getattr(self._table, name)[self.row] = value
+		self._table.touch(self.row)
+	return property(get, set)
+
+class BrushStroke(object):
+	"""
+	A view onto one row of a StrokeTable.  Views are cheap and made on
+	demand; two views of the same row and generation compare equal.
+	"""
+	__slots__ = ('_table', 'row', 'gen')
+	
+	def __init__(self, table, row):
+		self._table = table
+		self.row = row
+		self.gen = int(table.gen[row])
+		
+	def __eq__(self, other):
+		return ( isinstance(other, BrushStroke) and (other._table is self._table) and 
+		         (other.row == self.row) and (other.gen == self.gen) )
+	
+	def __ne__(self, other):
+		return not self.__eq__(other)
+	
+	def __hash__(self):
+		return hash((id(self._table), self.row, self.gen))
+	
+	x = _strokeColumn('x')
+	y = _strokeColumn('y')
+	w = _strokeColumn('w')
+	h = _strokeColumn('h')
+	rot = _strokeColumn('rot')
+	
+	@property
+	def imgPath(self):
+		return self._table.getPath(self.row)
+	
+	@property
+	def tile(self):
+		return self._table.getTile(self.row)
+
+	def draw(self, gc):
+		self.drawTo(gc, self.x, self.y)
+		
+	def drawTo(self, gc, x, y):
+		bmp = ImageCache.getInstance().getImage(self.tile)
+		rot = self.rot
+		w = bmp.GetWidth()
+		h = bmp.GetHeight()
+		if (rot == Brush.ROT_NONE):
+			gc.DrawBitmap(bmp, x, y, w, h)
+			return
+		
+		# Tiles are cached unrotated; turn the context about the stroke's
+		# top left corner so the rotated bitmap lands exactly on its rect.
+		gc.PushState()
+		if (rot == Brush.ROT_90):
+			gc.Translate(x + h, y)
+		elif (rot == Brush.ROT_180):
+			gc.Translate(x + w, y + h)
+		else:
+			gc.Translate(x, y + w)
+		gc.Rotate(rot * (math.pi / 2))
+		gc.DrawBitmap(bmp, 0, 0, w, h)
+		gc.PopState()
+
+	def getRect(self):
+		return (self.x, self.y, self.w, self.h)	
+	
+	def isInside(self, x, y):
+		return ( (x >= self.x) and 
+		         (y >= self.y) and
+		         (x < (self.x + self. w)) and 
+		         (y < (self.y + self.h)) )
+	
+	def rotate(self, direction=1):
+		self.rot = (self.rot + direction) % (Brush.ROT_270 + 1)
+		if (direction % 2):
+			self.w, self.h = self.h, self.w
+	
+	def toNode(self):
+		node = etree.Element("stroke")
+		node.set('imgPath', self.imgPath)
+		node.set('x', '%d' % self.x)
+		node.set('y', '%d' % self.y)
+		node.set('rot', str(self.rot))
+		node.set('tile', self.tile)
+		return node
+	
+	@staticmethod
+	def argsFromNode(node):
+		imgPath = node.get('imgPath')
+		x = int(node.get('x'))
+		y = int(node.get('y'))
+		rot = int(node.get('rot'))
+		tile = node.get('tile')
+		return (imgPath, x, y, rot, tile)
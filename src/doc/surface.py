@@ -0,0 +1,175 @@
+import functools
+import math
+
+from doc.pixels import arrayToBitmap
+from util.rects import alignRect, intersectRect, isEmpty
+
+TILE_SIZE = 512
+MAX_LEVEL = 6
+# Previews sample one map pixel in PREVIEW_STEP, at level 0.
+PREVIEW_STEP = 4
+
+class MapSurface(object):
+	"""
+	A white-masked rendering of a MapDocument kept as fixed size tiles,
+	with a mipmap level for each halving of the scale.  Tiles are rendered
+	when first drawn, on the TileRenderer if there is one, and again only
+	when a change touches them.
+	"""
+	def __init__(self, tileSize=TILE_SIZE, maxLevel=MAX_LEVEL, renderer=None):
+		self._tileSize = tileSize
+		self._maxLevel = maxLevel
+		self._renderer = renderer
+		self._pending = {}
+		self.reset()
+
+	def reset(self):
+		self.bounds = None
+		self._tiles = {}
+		for key in self._pending.keys():
+			self._cancel(key)
+
+	def update(self, doc, rect=None):
+		# Tiles the change touches stay drawable until they are rendered
+		# again, so editing never blanks part of the view.
+		bounds = doc.getBoundingRect()
+		if (isEmpty(bounds)):
+			self.bounds = None
+		else:
+			self.bounds = alignRect(bounds)
+
+		if (rect is None):
+			keys = set(self._tiles.keys() + self._pending.keys())
+		else:
+			rect = alignRect(rect)
+			keys = []
+			for level in xrange(self._maxLevel + 1):
+				keys.extend(self._tileKeys(rect, level))
+		for key in keys:
+			tile = self._tiles.get(key)
+			if (tile is not None):
+				self._tiles[key] = (tile[0], tile[1], False)
+			self._cancel(key)
+
+	def getLevel(self, scale):
+		# The coarsest level whose resolution is still at or above scale.
+		if (scale >= 1.0):
+			return 0
+		return min(self._maxLevel, int(math.floor(math.log(1.0 / scale, 2))))
+
+	def getTiles(self, doc, viewRect, level=0):
+		# Returns (rect, bmp) for every tile at level that overlaps
+		# viewRect, bottom to top.  Level 0 tiles are clipped to the map
+		# bounds, and re-rendered if the bounds have moved since they were
+		# drawn.
+		region = intersectRect(self.bounds, viewRect)
+		if (region is None):
+			self._retain([])
+			return []
+		keys = self._tileKeys(region, level)
+		if (self._renderer is None):
+			return [self._getTile(doc, key) for key in keys]
+
+		self._retain(keys)
+		placeholders = []
+		tiles = []
+		for key in keys:
+			rect = self._getTileRect(key)
+			tile = self._tiles.get(key)
+			if ((tile is None) or (tile[0] != rect) or (not tile[2])):
+				self._request(doc, key, rect, tile is None)
+			if (tile is None):
+				tile = self._findCoarser(key)
+				if ((tile is not None) and all((other is not tile) for other in placeholders)):
+					placeholders.append(tile)
+			else:
+				tiles.append(tile)
+		return [(rect, bmp) for rect, bmp, final in placeholders + tiles]
+
+	def addTile(self, key, token, bmp, final):
+		# Takes a tile from the renderer, or a bmp of None if rendering it
+		# failed, which leaves it to be requested again.  Returns False if
+		# there is nothing new to draw.
+		pending = self._pending.get(key)
+		if ((pending is None) or (pending[1] is not token)):
+			return False
+		if (bmp is None):
+			del self._pending[key]
+			return False
+		self._tiles[key] = (pending[0], bmp, final)
+		if (final):
+			del self._pending[key]
+		return True
+
+	def hasPending(self):
+		# Whether any tile is still waiting on the renderer.
+		return (len(self._pending) > 0)
+
+	def _getTile(self, doc, key):
+		rect = self._getTileRect(key)
+		tile = self._tiles.get(key)
+		if ((tile is None) or (tile[0] != rect) or (not tile[2])):
+			passes = self._getPasses(doc.snapshotRegion(rect), key, rect)
+			tile = self._tiles[key] = (rect, arrayToBitmap(passes[-1]()), True)
+		return tile[:2]
+
+	def _request(self, doc, key, rect, preview):
+		pending = self._pending.get(key)
+		if ((pending is not None) and (pending[0] == rect)):
+			return
+		self._cancel(key)
+		token = object()
+		self._pending[key] = (rect, token)
+		passes = self._getPasses(doc.snapshotRegion(rect), key, rect)
+		if (not preview):
+			passes = passes[-1:]
+		self._renderer.request(key, token, passes)
+
+	def _cancel(self, key):
+		if (self._pending.pop(key, None) is not None):
+			self._renderer.cancel(key)
+
+	def _retain(self, keys):
+		if (self._renderer is not None):
+			keys = set(keys)
+			for key in self._pending.keys():
+				if (key not in keys):
+					self._cancel(key)
+
+	def _getPasses(self, snapshot, key, rect):
+		# Functions rendering the tile, a quick preview first; each takes
+		# an optional cancelled callable.
+		level = key[0]
+		preview = functools.partial(snapshot.render, rect, PREVIEW_STEP << level)
+		if (level == 0):
+			return [preview, functools.partial(snapshot.render, rect)]
+		return [preview, functools.partial(snapshot.renderMean, rect, 1 << level)]
+
+	def _findCoarser(self, key):
+		level, tx, ty = key
+		while (level < self._maxLevel):
+			level += 1
+			tx >>= 1
+			ty >>= 1
+			tile = self._tiles.get((level, tx, ty))
+			if (tile is not None):
+				return tile
+		return None
+
+	def _getTileRect(self, key):
+		if (key[0] == 0):
+			return intersectRect(self._tileRect(key), self.bounds)
+		return self._tileRect(key)
+
+	def _tileRect(self, key):
+		level, tx, ty = key
+		span = self._tileSize << level
+		return (tx * span, ty * span, span, span)
+
+	def _tileKeys(self, rect, level=0):
+		span = float(self._tileSize << level)
+		x0 = int(math.floor(rect[0] / span))
+		y0 = int(math.floor(rect[1] / span))
+		x1 = int(math.ceil((rect[0] + rect[2]) / span))
+		y1 = int(math.ceil((rect[1] + rect[3]) / span))
+		return [(level, tx, ty) for ty in xrange(y0, y1) for tx in xrange(x0, x1)]
@@ -0,0 +1,135 @@
+import hashlib
+import numpy
+import os
+import threading
+import wx
+
+from util.files import replaceFile
+
+# Bytes of tiles kept on disk; beyond it the least recently used go.
+DISK_BUDGET = 1024 * 1024 * 1024
+# Bytes saved between checks of the budget.
+PRUNE_INTERVAL = 64 * 1024 * 1024
+
+class TileCache(object):
+	"""
+	Decoded tile pixels saved as .npy files, named by tile id and mask
+	mode, plus which tile each image file decodes to.  Tiles are memory
+	mapped when read back.
+	"""
+	def __init__(self, cacheDir, budget=DISK_BUDGET):
+		self._cacheDir = cacheDir
+		self._budget = budget
+		# The first save checks the budget, which an earlier session may
+		# have left the cache over.
+		self._written = PRUNE_INTERVAL
+		self._lock = threading.Lock()
+
+	@staticmethod
+	def getDefaultDir():
+		return os.path.join(wx.StandardPaths.Get().GetUserLocalDataDir(), 'tiles')
+
+	def hashFile(self, path):
+		sha = hashlib.sha1()
+		f = open(path, 'rb')
+		try:
+			sha.update(f.read())
+		finally:
+			f.close()
+		return sha.hexdigest()
+
+	def findTile(self, fileHash):
+		# The id of the tile the file with this hash decodes to, if known.
+		try:
+			f = open(os.path.join(self._cacheDir, 'files', fileHash), 'r')
+		except IOError:
+			return None
+		try:
+			return f.read().strip()
+		finally:
+			f.close()
+
+	def addFile(self, fileHash, tile):
+		self._write(os.path.join(self._cacheDir, 'files', fileHash), tile)
+
+	def load(self, tile, whiteMask):
+		# An (h, w, 4) or, for a grey tile, (h, w) read-only array mapped
+		# from the cache, or None.
+		path = self._getTilePath(tile, whiteMask)
+		if (not os.path.exists(path)):
+			return None
+		try:
+			pixels = numpy.load(path, mmap_mode='r')
+			os.utime(path, None)
+		except (IOError, OSError, ValueError):
+			return None
+		return pixels
+
+	def save(self, tile, whiteMask, pixels):
+		path = self._getTilePath(tile, whiteMask)
+		if (not os.path.exists(path)):
+			self._write(path, pixels)
+			with self._lock:
+				self._written += pixels.nbytes
+				if (self._written >= PRUNE_INTERVAL):
+					self._written = 0
+					self.prune()
+					
+	def prune(self):
+		# Removes tiles, least recently used first, until the rest fit the
+		# budget, then the records of files whose tiles have all gone.
+		try:
+			names = os.listdir(self._cacheDir)
+		except OSError:
+			return
+		tiles = []
+		total = 0
+		for name in names:
+			if (name.endswith('.npy')):
+				path = os.path.join(self._cacheDir, name)
+				try:
+					stat = os.stat(path)
+				except OSError:
+					continue
+				tiles.append((stat.st_mtime, stat.st_size, path))
+				total += stat.st_size
+		removed = set()
+		for mtime, size, path in sorted(tiles):
+			if (total <= self._budget):
+				break
+			try:
+				os.remove(path)
+			except OSError:
+				continue
+			total -= size
+			removed.add(os.path.basename(path).rsplit('-', 1)[0])
+		
+		filesDir = os.path.join(self._cacheDir, 'files')
+		if ((len(removed) == 0) or not os.path.isdir(filesDir)):
+			return
+		for fileHash in os.listdir(filesDir):
+			tile = self.findTile(fileHash)
+			if ( (tile in removed) and 
+			     not os.path.exists(self._getTilePath(tile, True)) and 
+			     not os.path.exists(self._getTilePath(tile, False)) ):
+				try:
+					os.remove(os.path.join(filesDir, fileHash))
+				except OSError:
+					pass
+
+	def _getTilePath(self, tile, whiteMask):
+		return os.path.join(self._cacheDir, '%s-%s.npy' % (tile, 'mask' if whiteMask else 'opaque'))
+
+	def _write(self, path, value):
+		try:
+			with replaceFile(path) as tmpPath:
+				f = open(tmpPath, 'wb')
+				try:
+					if (isinstance(value, numpy.ndarray)):
+						numpy.save(f, value)
+					else:
+						f.write(value)
+				finally:
+					f.close()
+		except (IOError, OSError):
+			pass
@@ -4,10 +4,15 @@
 # TODO:
 # 1. Clean up for distribution.
 #
+import argparse
+import multiprocessing
+import sys
+import time
 import wx
 
 import ui
 import doc
+from doc import export
 
 class GeomorphApp(wx.App):
 	def OnInit(self):
@@ -19,6 +24,46 @@ class GeomorphApp(wx.App):
 		
 		return True	
 	
+def exportMain(args):
+	parser = argparse.ArgumentParser(prog='geomorph.py export',
+	                                 description='Render saved maps to png files or tile pyramids without opening a window.')
+	parser.add_argument('maps', nargs='+', metavar='MAP',
+	                    help='map xml files to export; glob patterns are expanded')
+	parser.add_argument('-o', '--output', metavar='DIR', default=None,
+	                    help='directory to write to (default: next to each map)')
+	parser.add_argument('--scale', type=float, default=1.0,
+	                    help='size of the png relative to the map (default: %(default)s)')
+	parser.add_argument('--max-size', type=int, default=None, metavar='PIXELS',
+	                    help='shrink the png further if need be so neither side is longer than this')
+	parser.add_argument('--color', choices=('rgb', 'gray', 'mono'), default='rgb',
+	                    help='write an rgb, 8 bit grey or 1 bit black and white png (default: %(default)s)')
+	parser.add_argument('--pyramid', action='store_true',
+	                    help='write a Deep Zoom (.dzi) tile pyramid instead of a png; '
+	                         'tiles unchanged since the last export are kept')
+	parser.add_argument('--tile-size', type=int, default=export.TILE_SIZE, metavar='PIXELS',
+	                    help='pyramid tile size (default: %(default)s)')
+	parser.add_argument('-j', '--jobs', type=int, default=None,
+	                    help='number of worker processes, shared by the bands of a single map (default: one per cpu)')
+	options = parser.parse_args(args)
+
+	start = time.time()
+	failures = 0
+	if (options.pyramid):
+		results = export.exportPyramids(options.maps, options.output, options.jobs, options.tile_size)
+	else:
+		results = export.exportMaps(options.maps, options.output, options.jobs, options.scale, options.max_size, options.color)
+	for inPath, outPath, seconds, error in results:
+		if (error is None):
+			print '%s -> %s (%.2fs)' % (inPath, outPath, seconds)
+		else:
+			print '%s: FAILED, %s (%.2fs)' % (inPath, error, seconds)
+			failures += 1
+	print 'Finished in %.2fs' % (time.time() - start)
+	return 1 if failures else 0
+
 if __name__ == '__main__':
+	multiprocessing.freeze_support()
+	if ((len(sys.argv) > 1) and (sys.argv[1] == 'export')):
+		sys.exit(exportMain(sys.argv[2:]))
 	app = GeomorphApp(0)
 	app.MainLoop()
@@ -6,7 +6,7 @@ import shutil
 sys.argv.append('build')
 
 includes = ['encodings.utf_8', 'encodings.ascii',]
-packages = ['lxml._elementpath', 'gzip']
+packages = ['lxml._elementpath', 'gzip', 'numpy']
 
 executable = Executable(script='geomorph.py',
                         copyDependentFiles=True,
@@ -7,7 +7,7 @@ sys.argv.append('py2app')
 sys.argv.append('-A')
 
 includes = ['encodings.utf_8', 'encodings.ascii',]
-packages = ['lxml._elementpath', 'gzip']
+packages = ['lxml._elementpath', 'gzip', 'numpy']
 
 setup(name='Geomorph Painter',
       version='1.0',
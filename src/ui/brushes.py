@@ -1,8 +1,10 @@
+import bisect
 import os
 import random
 import wx
 
-from doc.map import ImageCache
+from doc.imagecache import ImageCache
+from ui.thumbnails import ThumbnailCache, ThumbnailLoader
 
 IMG_SIZE = 128
 
@@ -62,8 +64,12 @@ class BrushDirPanel(wx.Panel):
 class BrushPanel(wx.Panel):
 	def __init__(self, *args, **kwargs):
 		super(BrushPanel, self).__init__(*args, **kwargs)
+		self.items = []
+		cacheDir = os.path.join(wx.StandardPaths.Get().GetUserLocalDataDir(), 'thumbnails')
+		self._thumbnails = ThumbnailLoader(self._addBrush, ThumbnailCache(cacheDir, IMG_SIZE), IMG_SIZE)
 		self._layoutUI()
 		wx.GetApp().doc.addEventListener('onBrushDirChanged', self.onBrushDirChanged)
+		self.Bind(wx.EVT_WINDOW_DESTROY, self.onDestroy)
 		
 	def _layoutUI(self):	
 		sizer = wx.BoxSizer(wx.VERTICAL)
@@ -77,39 +83,31 @@ class BrushPanel(wx.Panel):
 		self.SetSizer(sizer)
 		
 	def _populateList(self, path):
+		# Thumbnails are built off the UI thread and added to the list as
+		# they arrive; picking another directory abandons the old scan.
+		self._thumbnails.cancel()
 		self.brushList.ClearAll()
 		
 		self.imageList = wx.ImageList(IMG_SIZE, IMG_SIZE)
+		self.brushList.SetImageList(self.imageList, wx.IMAGE_LIST_NORMAL)
 		
 		self.items = []
-		for root, dirs, files in os.walk(path):
-			names = [x for x in dirs]
-			names.sort()
-			for name in names:				
-				if (name.startswith('.')):
-					dirs.remove(name)
-					
-			for name in files:
-				imgPath = "%s/%s" % (root, name)
-				if (wx.Image.CanRead(imgPath)):
-					img = wx.Image(imgPath)
-					if (img.IsOk()):
-						img = img.Scale(IMG_SIZE, IMG_SIZE)
-						bmp = img.ConvertToBitmap()
-						if ((bmp.GetWidth() != IMG_SIZE) or (bmp.GetHeight() != IMG_SIZE)):
-							raise Exception("Houston, we have a problem.")
-						imgIndex = self.imageList.Add(bmp)
-						self.items.append((name.split('.')[0], imgIndex, imgPath))
-						
-		self.brushList.SetImageList(self.imageList, wx.IMAGE_LIST_NORMAL)
-	
-		for i in xrange(len(self.items)):
-			name, imgIndex, imgPath = self.items[i]
-			self.brushList.InsertItem(i, imgIndex)
-			#self.brushList.InsertImageStringItem(i, name, imgIndex)
+		self._thumbnails.start(path)
+		
+	def _addBrush(self, imgPath, bmp):
+		# Keep the list in path order however the workers finish.
+		name = os.path.basename(imgPath)
+		imgIndex = self.imageList.Add(bmp)
+		i = bisect.bisect([item[2] for item in self.items], imgPath)
+		self.items.insert(i, (name.split('.')[0], imgIndex, imgPath))
+		self.brushList.InsertItem(i, imgIndex)
 	
 	def onBrushDirChanged(self, brushDir):
 		self._populateList(brushDir)
+		
+	def onDestroy(self, event):
+		self._thumbnails.cancel()
+		event.Skip()
 	
 	def onBrushSelected(self, event):
 		wx.GetApp().doc.setBrush(self.items[event.Index][2])
@@ -1,6 +1,13 @@
 import wx
 
+from doc.surface import MapSurface
 from ui import tools
+from ui.renderer import TileRenderer
+from ui.scheduler import RenderScheduler
+from util.rects import alignRect
+
+# Extra pixels refreshed around tool overlays, for antialiasing.
+OVERLAY_PAD = 2
 
 class CanvasPanel(wx.Panel):
 	def __init__(self, *args, **kwargs):
@@ -9,9 +16,14 @@ class CanvasPanel(wx.Panel):
 		self.SetDoubleBuffered(True)
 
 		self._offset = [0, 0]
-		self._mapBmp = None
+		self._surface = MapSurface(renderer=TileRenderer(self._onTileRendered))
 		self._grid = None
+		self._gridLayer = None
 		self._buffer = None
+		self._composite = None
+		self._compositeKey = None
+		self._overlayRect = None
+		self._scheduler = RenderScheduler(self)
 		self._scale = 1.0
 		
 		self._mouse = (0, 0)
@@ -33,15 +45,16 @@ class CanvasPanel(wx.Panel):
 		self.Bind(wx.EVT_MOUSEWHEEL, self.onWheel)
 		self.Bind(wx.EVT_KEY_DOWN, self.onKeyDown)
 		self.Bind(wx.EVT_KEY_UP, self.onKeyUp)
+		self.Bind(wx.EVT_WINDOW_DESTROY, self.onDestroy)
 		
-		wx.GetApp().doc.addEventListener('onMapChanged', self.onMapChanged)
+		wx.GetApp().doc.addEventListener('onMapChanged', self._scheduler.deferMapChanged(self.onMapChanged))
 		wx.GetApp().doc.addEventListener('onNewMap', self.onNewMap)
 		wx.GetApp().doc.addEventListener('onGridChanged', self.onGridChanged)
 		
 	def reset(self):
 		self._offset = [0, 0]
 		self._scale = 1.0
-		self._mapBmp = None
+		self._surface.reset()
 		
 	def offset(self, x, y):
 		self._offset[0] += x
@@ -50,52 +63,112 @@ class CanvasPanel(wx.Panel):
 	def getOffset(self):
 		return self._offset
 		
+	def getScheduler(self):
+		return self._scheduler
+		
 	def setTool(self, tool):
 		self._tool = tool
+		self._scheduler.refresh()
 		
-	def onMapChanged(self, doc, needsPaint):
+	def onMapChanged(self, doc, needsPaint, rect=None):
 		if (needsPaint):
-			xOff, yOff, self._mapBmp = doc.buildImage()
-			if (self._mapBmp is not None):
-				self.offset(xOff * self._scale, yOff * self._scale)
-			self.Refresh()
+			self._surface.update(doc, rect)
+			self._compositeKey = None
+			self._scheduler.refresh()
+			
+	def _onTileRendered(self, key, token, bmp, final):
+		if (self._surface.addTile(key, token, bmp, final)):
+			self._compositeKey = None
+			self._scheduler.refresh()
+			if (final):
+				wx.GetApp().doc.markFirstPaint()
 			
 	def onNewMap(self, doc):
 		self.reset()
-		xOff, yOff, self._mapBmp = doc.buildImage()
-		self.Refresh()		
+		self._surface.update(doc)
+		self._compositeKey = None
+		self._scheduler.refresh()		
 			
 	def onGridChanged(self, grid):
 		self._grid = grid
-		self.Refresh()
+		# The map bounds snap to the grid, so cached tiles may be stale.
+		self._surface.update(wx.GetApp().doc)
+		self._compositeKey = None
+		self._scheduler.refresh()
 		
 	def onSize(self, event):
 		w, h = self.GetClientSize()
 		self._buffer = wx.Bitmap(w, h)
-		self.Refresh()
+		self._scheduler.refresh()
+		
+	def onDestroy(self, event):
+		# Drops the tiles still queued for rendering.
+		self._surface.reset()
+		event.Skip()
 		
 	def onPaint(self, event):
+		# The background, grid and map are composited once per view and
+		# reused; only the tool overlay is drawn on every paint.
 		dc = wx.BufferedPaintDC(self, self._buffer)
 		try:
+			self._updateComposite()
 			gc = wx.GraphicsContext.Create(dc)
 		except NotImplementedError:
 			dc.DrawText("This build of wxPython does not support the wx.GraphicsContext "
 						"family of classes.", 25, 25)
 			return	
 
-		gc.PushState()									
+		gc.DrawBitmap(self._composite, 0, 0, *self._composite.GetSize())
+		if (self._tool is not None):
+			gc.PushState()
+			self._tool.draw(gc, self._mouse[0], self._mouse[1])
+			gc.PopState()
+			self._overlayRect = self._tool.getOverlayRect()
+		# Otherwise the first final tile delivered marks the first paint.
+		if (not self._surface.hasPending()):
+			wx.GetApp().doc.markFirstPaint()
+		
+	def _getViewKey(self):
+		return (tuple(self._offset), self._scale, tuple(self.GetClientSize()))
+		
+	def _updateComposite(self):
+		key = self._getViewKey()
+		if ((self._composite is not None) and (self._compositeKey == key)):
+			return
+		w, h = self.GetClientSize()
+		self._composite = wx.Bitmap(max(w, 1), max(h, 1))
+		dc = wx.MemoryDC()
+		dc.SelectObject(self._composite)
+		gc = wx.GraphicsContext.Create(dc)
+		gc.PushState()
 		self._draw(gc)
 		gc.PopState()
+		del gc
+		dc.SelectObject(wx.NullBitmap)
+		self._compositeKey = key
+		
+	def _refreshTool(self, needsRefresh):
+		# A tool that only moved its overlay repaints the overlay's old and
+		# new rects over the cached composite; one that moved the view
+		# repaints everything.
+		if (not needsRefresh):
+			return
+		if (self._compositeKey != self._getViewKey()):
+			self._scheduler.refresh()
+			return
+		for rect in (self._overlayRect, self._tool.getOverlayRect()):
+			if (rect is not None):
+				x, y, w, h = alignRect(rect)
+				self._scheduler.refreshRect((x - OVERLAY_PAD, y - OVERLAY_PAD, 
+				                             w + (OVERLAY_PAD * 2), h + (OVERLAY_PAD * 2)))
 		
 	def onMouseEnter(self, event):
 		if (self._tool is not None):
-			if (self._tool.onMouseEnter()):
-				self.Refresh()
+			self._refreshTool(self._tool.onMouseEnter())
 		
 	def onMouseExit(self, event):
 		if (self._tool is not None):
-			if (self._tool.onMouseExit()):
-				self.Refresh()
+			self._refreshTool(self._tool.onMouseExit())
 	
 	def onMouseMove(self,event):
 		self._axisLock = (event.ShiftDown(), event.ControlDown())
@@ -109,33 +182,28 @@ class CanvasPanel(wx.Panel):
 			self._mouse = (mousePos[0], self._mouse[1])
 			
 		if (self._tool is not None):
-			if (self._tool.onMouseMove(self._mouse[0], self._mouse[1])):
-				self.Refresh()	
+			self._refreshTool(self._tool.onMouseMove(self._mouse[0], self._mouse[1]))
 				
 		event.Skip()
 			
 	def onLeftDown(self, event):
 		if (self._tool is not None):
-			if (self._tool.onLeftDown(self._mouse[0], self._mouse[1])):
-				self.Refresh()
+			self._refreshTool(self._tool.onLeftDown(self._mouse[0], self._mouse[1]))
 		event.Skip()
 
 	def onLeftUp(self, event):
 		if (self._tool is not None):
-			if (self._tool.onLeftUp(self._mouse[0], self._mouse[1])):
-				self.Refresh()
+			self._refreshTool(self._tool.onLeftUp(self._mouse[0], self._mouse[1]))
 		event.Skip()
 	
 	def onRightDown(self, event):
 		if (self._tool is not None):
-			if (self._tool.onRightDown(self._mouse[0], self._mouse[1])):
-				self.Refresh()
+			self._refreshTool(self._tool.onRightDown(self._mouse[0], self._mouse[1]))
 		event.Skip()
 			
 	def onRightUp(self, event):
 		if (self._tool is not None):
-			if (self._tool.onRightUp(self._mouse[0], self._mouse[1])):
-				self.Refresh()
+			self._refreshTool(self._tool.onRightUp(self._mouse[0], self._mouse[1]))
 		event.Skip()
 		
 	def onWheel(self, event):
@@ -146,14 +214,12 @@ class CanvasPanel(wx.Panel):
 
 	def onKeyDown(self, event):
 		if (self._tool is not None):
-			if (self._tool.onKeyDown(event.GetKeyCode())):
-				self.Refresh()
+			self._refreshTool(self._tool.onKeyDown(event.GetKeyCode()))
 		event.Skip()
 
 	def onKeyUp(self, event):
 		if (self._tool is not None):
-			if (self._tool.onKeyUp(event.GetKeyCode())):
-				self.Refresh()
+			self._refreshTool(self._tool.onKeyUp(event.GetKeyCode()))
 		event.Skip()
 				
 	def onMiddleDown(self, event):
@@ -166,7 +232,7 @@ class CanvasPanel(wx.Panel):
 		if (self._savedToolId is not None):
 			self._tool.setEnabled(False)
 			wx.GetApp().mainWindow.setTool(self._savedToolId)
-			self.Refresh()
+			self._scheduler.refresh()
 		self._savedToolId = None
 		event.Skip()
 		
@@ -183,7 +249,7 @@ class CanvasPanel(wx.Panel):
 		if (self._tool is not None):
 			self._tool.onMouseMove(*self._mouse)
 			
-		self.Refresh()
+		self._scheduler.refresh()
 
 	def modifyScale(self, increment, centerPt=None):
 		self.setScale(self._scale + (self._scale * increment), centerPt)
@@ -209,11 +275,8 @@ class CanvasPanel(wx.Panel):
 		if ((self._grid is not None) and self._grid.enabled and self._grid.renderAbove):
 			self._drawGrid(gc)
 		
-		if (self._tool is not None):
-			self._tool.draw(gc, self._mouse[0], self._mouse[1])
-		
 	def _drawMap(self, gc):		
-		if (self._mapBmp is None):
+		if (self._surface.bounds is None):
 			return
 		
 		gc.PushState()
@@ -224,31 +287,52 @@ class CanvasPanel(wx.Panel):
 		color = wx.Colour(255, 255, 255)
 		gc.SetBrush(wx.Brush(color))
 		
-		w = self._mapBmp.GetWidth()
-		h = self._mapBmp.GetHeight()
-		gc.DrawBitmap(self._mapBmp, 0, 0, w, h)
+		doc = wx.GetApp().doc
+		level = self._surface.getLevel(self._scale)
+		for (x, y, w, h), bmp in self._surface.getTiles(doc, self._getViewRect(), level):
+			gc.DrawBitmap(bmp, x, y, w, h)
 		
 		gc.PopState()
+		
+	def _getViewRect(self):
+		# The area of the map visible in the client window.
+		w, h = self.GetClientSize()
+		x, y = self.toMapCoord(0, 0)
+		return (x - 1, y - 1, (w / self._scale) + 2, (h / self._scale) + 2)
 			
 	def _drawGrid(self, gc):
 		if ((self._grid is None) or (not self._grid.enabled)):
 			return
 			
-		gc.PushState()
-		
 		gridW = self._grid.w * self._scale
 		gridH = self._grid.h * self._scale
 
 		x = (self._offset[0] % gridW) - gridW
 		y = (self._offset[1] % gridH) - gridH
-				
-		gc.Translate(x, y)
-		gc.Scale(self._scale, self._scale)
 		
+		# The grid is drawn into its own layer, which is reused until the
+		# grid, the scale, the window size or the grid's phase in the
+		# window changes.
 		w, h = self.GetClientSize()
+		if ((w < 1) or (h < 1)):
+			return
+		key = (self._grid.getKey(), self._scale, x, y, w, h)
+		if ((self._gridLayer is None) or (self._gridLayer[0] != key)):
+			self._gridLayer = (key, self._renderGrid(x, y, w, h))
+		gc.DrawBitmap(self._gridLayer[1], 0, 0, w, h)
+		
+	def _renderGrid(self, x, y, w, h):
+		bmp = wx.Bitmap.FromRGBA(w, h, 0, 0, 0, 0)
+		dc = wx.MemoryDC()
+		dc.SelectObject(bmp)
+		gc = wx.GraphicsContext.Create(dc)
+		
+		gc.Translate(x, y)
+		gc.Scale(self._scale, self._scale)
 		self._grid.draw(gc, 
-		                (w / self._scale) + gridW, 
-		                (h / self._scale) + gridH)
+		                (w / self._scale) + self._grid.w, 
+		                (h / self._scale) + self._grid.h)
 		
-		gc.PopState()
-			
\ No newline at end of file
+		del gc
+		dc.SelectObject(wx.NullBitmap)
+		return bmp
@@ -23,7 +23,9 @@ class MainFrame(wx.Frame):
 		self.SetIcon(images.App.GetIcon())
 		
 		self.randomizeBrushes = False
-		wx.GetApp().doc.addEventListener('onMapChanged', self._onMapChanged)
+		wx.GetApp().doc.addEventListener('onMapChanged', 
+		                                 self._canvas.getScheduler().deferMapChanged(self._onMapChanged))
+		wx.GetApp().doc.addEventListener('onMapLoaded', self._onMapLoaded)
 
 	def getToolId(self):
 		return self._curToolId
@@ -192,10 +194,14 @@ class MainFrame(wx.Frame):
 	def updateRandomizeBrushes(self, event):
 		event.Check(self.randomizeBrushes)
 		
-	def _onMapChanged(self, doc, needsRepaint):
+	def _onMapChanged(self, doc, needsRepaint, rect=None):
 		if (self.randomizeBrushes):
 			self.randomizeBrush(doc)
 				
+	def _onMapLoaded(self, timings):
+		self.SetStatusText("Loaded in %.2fs: parse %.2fs, decode %.2fs, mask %.2fs" % 
+		                   (timings['firstPaint'], timings['parse'], timings['decode'], timings['mask']))
+		
 	def randomizeBrush(self, doc):
 		brush = doc.setBrush(self._brushes.getRandomBrush())
 		for i in xrange(random.randint(0, 3)):
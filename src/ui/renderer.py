@@ -0,0 +1,65 @@
+import traceback
+import wx
+
+from doc.pixels import arrayToBitmap
+from util.workers import WorkerPool
+
+class TileRenderer(object):
+	"""
+	Renders map tiles on background threads.  A request is a list of
+	passes, each returning an RGBA array, whose results are handed to
+	callback(key, token, bmp, final) on the UI thread; a bmp of None means
+	the request failed.
+	"""
+	def __init__(self, callback, workers=None):
+		self._callback = callback
+		self._jobs = {}
+		self._pool = WorkerPool(self._run, workers)
+
+	def request(self, key, token, passes):
+		job = _RenderJob(key, token, passes)
+		self._jobs[key] = job
+		self._pool.put(job)
+
+	def cancel(self, key):
+		self._jobs.pop(key, None)
+
+	def _isCurrent(self, job):
+		return (self._jobs.get(job.key) is job)
+
+	def _run(self, job):
+		if (not self._isCurrent(job)):
+			return
+		try:
+			pixels = job.passes[job.index](cancelled=lambda: not self._isCurrent(job))
+		except Exception:
+			traceback.print_exc()
+			wx.CallAfter(self._fail, job)
+			return
+		if (pixels is None):
+			return
+		job.index += 1
+		final = (job.index == len(job.passes))
+		wx.CallAfter(self._deliver, job, pixels, final)
+		if (not final):
+			self._pool.put(job)
+
+	def _deliver(self, job, pixels, final):
+		# Bitmaps can only be created on the UI thread.
+		if (self._isCurrent(job)):
+			if (final):
+				del self._jobs[job.key]
+			self._callback(job.key, job.token, arrayToBitmap(pixels), final)
+			
+	def _fail(self, job):
+		if (self._isCurrent(job)):
+			del self._jobs[job.key]
+			self._callback(job.key, job.token, None, True)
+
+
+class _RenderJob(object):
+	def __init__(self, key, token, passes):
+		self.key = key
+		self.token = token
+		self.passes = passes
+		self.index = 0
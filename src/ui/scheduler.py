@@ -0,0 +1,110 @@
+import math
+import time
+import wx
+
+from util.rects import unionRect
+
+MAX_FPS = 60
+
+class RenderScheduler(object):
+	"""
+	Collects repaint requests for a window and flushes them at most once
+	per frame, merging the onMapChanged notifications of listeners wrapped
+	with deferMapChanged the same way.
+	"""
+	def __init__(self, window, fps=MAX_FPS):
+		self._window = window
+		self._interval = 1.0 / fps
+		self._pending = False
+		self._flushing = False
+		self._full = False
+		self._rects = []
+		self._deferred = []
+		self._lastFrame = 0.0
+		self.frames = 0
+		self.requests = 0
+		self.dropped = 0
+		self.frameTime = 0.0
+		self.totalFrameTime = 0.0
+
+	def refresh(self):
+		self._full = True
+		self._rects = []
+		self._request()
+
+	def refreshRect(self, rect):
+		if (not self._full):
+			self._rects.append(rect)
+		self._request()
+
+	def deferMapChanged(self, callback):
+		# Returns an onMapChanged listener that calls callback once per
+		# frame, with needsPaint set if any change needed painting and the
+		# union of their rects (None if any covered the whole map).
+		entry = [callback, None]
+		self._deferred.append(entry)
+		def listener(doc, needsPaint, rect=None):
+			pending = entry[1]
+			if (pending is None):
+				entry[1] = [doc, needsPaint, rect]
+			elif (needsPaint):
+				if (not pending[1]):
+					pending[1] = True
+					pending[2] = rect
+				elif ((pending[2] is not None) and (rect is not None)):
+					pending[2] = unionRect(pending[2], rect)
+				else:
+					pending[2] = None
+			self._request()
+		return listener
+
+	def getStats(self):
+		if (self.frames > 0):
+			average = self.totalFrameTime / self.frames
+		else:
+			average = 0.0
+		return {'frames': self.frames,
+		        'requests': self.requests,
+		        'dropped': self.dropped,
+		        'frameTime': self.frameTime,
+		        'averageFrameTime': average}
+
+	def _request(self):
+		self.requests += 1
+		if (self._pending or self._flushing):
+			self.dropped += 1
+			return
+		self._pending = True
+		delay = (self._lastFrame + self._interval) - time.time()
+		if (delay > 0):
+			wx.CallLater(int(math.ceil(delay * 1000)), self.flush)
+		else:
+			wx.CallAfter(self.flush)
+
+	def flush(self):
+		if ((not self._pending) or (not self._window)):
+			return
+		start = time.time()
+		self._flushing = True
+		try:
+			for entry in self._deferred:
+				if (entry[1] is not None):
+					args = entry[1]
+					entry[1] = None
+					entry[0](*args)
+
+			if (self._full):
+				self._window.Refresh()
+			else:
+				for x, y, w, h in self._rects:
+					self._window.RefreshRect(wx.Rect(x, y, w, h), False)
+			self._full = False
+			self._rects = []
+			self._window.Update()
+		finally:
+			self._flushing = False
+			self._pending = False
+		self._lastFrame = start
+		self.frameTime = time.time() - start
+		self.totalFrameTime += self.frameTime
+		self.frames += 1
@@ -0,0 +1,101 @@
+import hashlib
+import os
+import wx
+
+from util.files import replaceFile
+from util.workers import WorkerPool, startThread
+
+THUMB_SIZE = 128
+
+class ThumbnailCache(object):
+	"""
+	Scaled brush images saved as pngs, named by a hash of the source path,
+	modification time, size and thumbnail size.
+	"""
+	def __init__(self, cacheDir, size=THUMB_SIZE):
+		self._cacheDir = cacheDir
+		self._size = size
+
+	def load(self, imgPath):
+		cachePath = self._getCachePath(imgPath)
+		if ((cachePath is None) or (not os.path.exists(cachePath))):
+			return None
+		img = wx.Image(cachePath, wx.BITMAP_TYPE_PNG)
+		if (not img.IsOk()):
+			return None
+		return img
+
+	def save(self, imgPath, img):
+		cachePath = self._getCachePath(imgPath)
+		if (cachePath is None):
+			return
+		try:
+			with replaceFile(cachePath) as tmpPath:
+				img.SaveFile(tmpPath, wx.BITMAP_TYPE_PNG)
+		except (IOError, OSError):
+			pass
+
+	def _getCachePath(self, imgPath):
+		try:
+			st = os.stat(imgPath)
+		except OSError:
+			return None
+		key = '%s|%r|%d|%d' % (os.path.abspath(imgPath), st.st_mtime, st.st_size, self._size)
+		return os.path.join(self._cacheDir, '%s.png' % hashlib.sha1(key).hexdigest())
+
+
+class ThumbnailLoader(object):
+	"""
+	Scans a brush directory and builds thumbnails for it on background
+	threads, handing each to callback(imgPath, bmp) on the UI thread.
+	"""
+	def __init__(self, callback, cache, size=THUMB_SIZE, workers=None):
+		self._callback = callback
+		self._cache = cache
+		self._size = size
+		self._generation = 0
+		self._pool = WorkerPool(self._build, workers)
+
+	def start(self, path):
+		self.cancel()
+		startThread(self._scan, self._generation, path)
+
+	def cancel(self):
+		self._generation += 1
+		self._pool.clear()
+
+	def _scan(self, generation, path):
+		for root, dirs, files in os.walk(path):
+			if (generation != self._generation):
+				return
+			for name in list(dirs):
+				if (name.startswith('.')):
+					dirs.remove(name)
+			for name in sorted(files):
+				self._pool.put((generation, "%s/%s" % (root, name)))
+
+	def _build(self, item):
+		generation, imgPath = item
+		if (generation != self._generation):
+			return
+		img = self._cache.load(imgPath)
+		if (img is None):
+			img = self._makeThumbnail(imgPath)
+			if (img is None):
+				return
+			self._cache.save(imgPath, img)
+		if (generation == self._generation):
+			wx.CallAfter(self._deliver, generation, imgPath, img)
+
+	def _makeThumbnail(self, imgPath):
+		if (not wx.Image.CanRead(imgPath)):
+			return None
+		img = wx.Image(imgPath)
+		if (not img.IsOk()):
+			return None
+		return img.Scale(self._size, self._size)
+
+	def _deliver(self, generation, imgPath, img):
+		# Bitmaps can only be created on the UI thread.
+		if (generation == self._generation):
+			self._callback(imgPath, img.ConvertToBitmap())
@@ -34,6 +34,11 @@ class ITool(object):
 		pass
 	def draw(self, gc, x, y):
 		pass	
+	def getOverlayRect(self):
+		# The window area draw() paints, or None if it paints nothing.
+		# Tools that don't say are assumed to paint anywhere.
+		w, h = self._canvas.GetClientSize()
+		return (0, 0, w, h)
 	
 def getMapPoint(canvas, x, y, snapToGrid=True):
 	doc = wx.GetApp().doc
@@ -105,6 +110,14 @@ class BrushTool(ITool):
 			return True
 		return False
 
+	def getOverlayRect(self):
+		if ((not self._hasMouse) or (self._brush is None) or (self._lastBrushPt is None)):
+			return None
+		scale = self._canvas.getScale()
+		w, h = self._brush.getSize()
+		return (self._lastBrushPt[0] - ((w / 2) * scale), self._lastBrushPt[1] - ((h / 2) * scale),
+		        w * scale, h * scale)
+
 	def draw(self, gc, x, y):
 		if (not self._hasMouse):
 			return
@@ -147,6 +160,9 @@ class MoveTool(ITool):
 			needsRefresh = True		
 		self._lastMouse = (x, y)
 		return needsRefresh	
+		
+	def getOverlayRect(self):
+		return None
 	
 class SelectTool(ITool):
 	def __init__(self, canvas):
@@ -172,6 +188,20 @@ class SelectTool(ITool):
 		self._popupMenu.Append(delId, "Delete")
 		self._canvas.Bind(wx.EVT_MENU, self.onDelete, id=delId)
 		
+		wx.GetApp().doc.addEventListener('onNewMap', self.onNewMap)
+		
+	def onNewMap(self, doc):
+		self._selectedStroke = None
+		self._dragging = False
+		
+	def _getSelectedStroke(self):
+		# The selection goes with its stroke, however that was removed.
+		if ( (self._selectedStroke is not None) and 
+		     not wx.GetApp().doc.hasStroke(self._selectedStroke) ):
+			self._selectedStroke = None
+			self._dragging = False
+		return self._selectedStroke
+		
 	def onLeftDown(self, x, y):		
 		mapCoords = self._canvas.toMapCoord(x, y)
 		self._selectedStroke = wx.GetApp().doc.selectStroke(*mapCoords)
@@ -183,7 +213,7 @@ class SelectTool(ITool):
 			self._dragOffset[1] += (self._selectedStroke.y + self._selectedStroke.h/2) * self._canvas.getScale()
 
 			self._ptBrush = getMapPoint(self._canvas, x + self._dragOffset[0], y + self._dragOffset[1], False)
-			wx.GetApp().doc.markDirty()
+			wx.GetApp().doc.markDirty(rect=self._selectedStroke.getRect())
 			self._dragging = True
 		return True
 	
@@ -210,42 +240,40 @@ class SelectTool(ITool):
 		self._canvas.PopupMenu(self._popupMenu)
 
 	def onKeyDown(self, key):
-		if (self._selectedStroke is not None):
+		if (self._getSelectedStroke() is not None):
 			if (key == wx.WXK_LEFT):
-				self._selectedStroke.x -= 1
-				wx.GetApp().doc.markDirty()
+				self._nudgeStroke(-1, 0)
 				return True
 			elif (key == wx.WXK_RIGHT):
-				self._selectedStroke.x += 1
-				wx.GetApp().doc.markDirty()
+				self._nudgeStroke(1, 0)
 				return True
 			elif (key == wx.WXK_UP):
-				self._selectedStroke.y -= 1
-				wx.GetApp().doc.markDirty()
+				self._nudgeStroke(0, -1)
 				return True
 			elif (key == wx.WXK_DOWN):
-				self._selectedStroke.y += 1
-				wx.GetApp().doc.markDirty()
+				self._nudgeStroke(0, 1)
 				return True
 			elif (key == wx.WXK_DELETE):
 				self._deleteStroke()
 				return True
 	
+	def _nudgeStroke(self, dx, dy):
+		stroke = self._selectedStroke
+		wx.GetApp().doc.moveStroke(stroke, stroke.x + dx, stroke.y + dy)
+	
 	def onRotateClockwise(self, event):
-		if (self._selectedStroke is not None):
-			self._selectedStroke.rotate(1)
-			wx.GetApp().doc.markDirty()
+		if (self._getSelectedStroke() is not None):
+			wx.GetApp().doc.rotateStroke(self._selectedStroke, 1)
 	
 	def onRotateCounterClockwise(self, event):
-		if (self._selectedStroke is not None):
-			self._selectedStroke.rotate(-1)
-			wx.GetApp().doc.markDirty()
+		if (self._getSelectedStroke() is not None):
+			wx.GetApp().doc.rotateStroke(self._selectedStroke, -1)
 	
 	def onDelete(self, event):
 		self._deleteStroke()
 		
 	def _deleteStroke(self):
-		if (self._selectedStroke is None):
+		if (self._getSelectedStroke() is None):
 			mapCoords = self._canvas.toMapCoord(*self._lastMouse)
 			self._selectedStroke = wx.GetApp().doc.selectStroke(*mapCoords)
 		if (self._selectedStroke is not None):
@@ -255,8 +283,25 @@ class SelectTool(ITool):
 	def onActivated(self):
 		self._selectedStroke = None		
 		
+	def getOverlayRect(self):
+		if (self._getSelectedStroke() is None):
+			return None
+		scale = self._canvas.getScale()
+		w = self._selectedStroke.w * scale
+		h = self._selectedStroke.h * scale
+		if (self._dragging):
+			x = self._ptBrush[0] - ((self._selectedStroke.w / 2) * scale)
+			y = self._ptBrush[1] - ((self._selectedStroke.h / 2) * scale)
+		else:
+			offset = self._canvas.getOffset()
+			x = offset[0] + (self._selectedStroke.x * scale)
+			y = offset[1] + (self._selectedStroke.y * scale)
+		# Leave room for the outline's pen.
+		pen = 3 * scale
+		return (x - pen, y - pen, w + (pen * 2), h + (pen * 2))
+		
 	def draw(self, gc, x, y):
-		if (self._selectedStroke is not None):
+		if (self._getSelectedStroke() is not None):
 			gc.PushState()			
 			scale = self._canvas.getScale()
 			if (self._dragging):
@@ -0,0 +1,31 @@
+import contextlib
+import os
+import threading
+
+@contextlib.contextmanager
+def replaceFile(path):
+	# Yields a private path to write path's new contents to, which is
+	# renamed into place afterwards, so other threads and processes never
+	# see half a file.  The private file is removed if writing fails.
+	tmpPath = '%s.%d.%d.tmp' % (path, os.getpid(), threading.current_thread().ident)
+	try:
+		makeDirs(os.path.dirname(path))
+		yield tmpPath
+		if ((os.name == 'nt') and os.path.exists(path)):
+			# Windows won't rename over an existing file.
+			os.remove(path)
+		os.rename(tmpPath, path)
+	except:
+		if (os.path.exists(tmpPath)):
+			os.remove(tmpPath)
+		raise
+
+def makeDirs(path):
+	# Allows for another process or thread making the directory between
+	# the check and os.makedirs.
+	if ((path != '') and not os.path.isdir(path)):
+		try:
+			os.makedirs(path)
+		except OSError:
+			if (not os.path.isdir(path)):
+				raise
@@ -0,0 +1,43 @@
+import math
+
+# Rectangles are (x, y, w, h) tuples.  None is used for "no rectangle".
+
+def isEmpty(rect):
+	return ((rect is None) or (rect[2] <= 0) or (rect[3] <= 0))
+
+def unionRect(a, b):
+	if (isEmpty(a)):
+		return b
+	if (isEmpty(b)):
+		return a
+	x = min(a[0], b[0])
+	y = min(a[1], b[1])
+	return (x, y,
+	        max(a[0] + a[2], b[0] + b[2]) - x,
+	        max(a[1] + a[3], b[1] + b[3]) - y)
+
+def intersectRect(a, b):
+	if (isEmpty(a) or isEmpty(b)):
+		return None
+	x = max(a[0], b[0])
+	y = max(a[1], b[1])
+	w = min(a[0] + a[2], b[0] + b[2]) - x
+	h = min(a[1] + a[3], b[1] + b[3]) - y
+	if ((w <= 0) or (h <= 0)):
+		return None
+	return (x, y, w, h)
+
+def containsRect(outer, inner):
+	return ( (not isEmpty(outer)) and
+	         (inner[0] >= outer[0]) and
+	         (inner[1] >= outer[1]) and
+	         (inner[0] + inner[2] <= outer[0] + outer[2]) and
+	         (inner[1] + inner[3] <= outer[1] + outer[3]) )
+
+def alignRect(rect):
+	# Grow a rectangle outwards to whole pixels.
+	x = int(math.floor(rect[0]))
+	y = int(math.floor(rect[1]))
+	return (x, y,
+	        int(math.ceil(rect[0] + rect[2])) - x,
+	        int(math.ceil(rect[1] + rect[3])) - y)
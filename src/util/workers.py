@@ -0,0 +1,46 @@
+import multiprocessing
+import Queue
+import threading
+import traceback
+
+MAX_WORKERS = 4
+
+def startThread(target, *args):
+	# A daemon thread, so unfinished background work never keeps the
+	# application from exiting.
+	thread = threading.Thread(target=target, args=args)
+	thread.daemon = True
+	thread.start()
+	return thread
+
+class WorkerPool(object):
+	"""
+	Background threads handing each item put on a shared queue to
+	handle(item), one item per thread at a time.
+	"""
+	def __init__(self, handle, workers=None):
+		self._handle = handle
+		self._queue = Queue.Queue()
+		if (workers is None):
+			workers = min(MAX_WORKERS, multiprocessing.cpu_count())
+		for i in xrange(workers):
+			startThread(self._work)
+
+	def put(self, item):
+		self._queue.put(item)
+
+	def clear(self):
+		# Drops the items no thread has taken yet.
+		try:
+			while (True):
+				self._queue.get_nowait()
+		except Queue.Empty:
+			pass
+
+	def _work(self):
+		while (True):
+			item = self._queue.get()
+			try:
+				self._handle(item)
+			except Exception:
+				traceback.print_exc()
@@ -7,7 +7,7 @@ import time
 sys.argv.append('py2exe')
 
 includes = ['encodings.utf_8', 'encodings.ascii',]
-packages = ['lxml._elementpath', 'inspect', 'gzip']
+packages = ['lxml._elementpath', 'inspect', 'gzip', 'numpy']
 
 setup(windows=[{'script':'geomorph.py',
 				'icon_resources':[(1,'../images/icon.ico')]